@@ -1,14 +1,56 @@
 import requests
 import base64
-from pprint import pformat
-from datetime import datetime
+import itertools
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from dataclasses import dataclass
+from typing import Optional
 from logging import Logger
+from logs import Payload
+from metrics import metrics, endpoint_name
 from ocr_solver import OCRSolver
+from captcha_pool import CaptchaPool
+from captcha_corpus import CaptchaCorpus
+from token_manager import TokenManager
+from booked_slot_cache import BookedSlotCache
+
+def parse_slot_date(value: str) -> date:
+    ''' Parse the date of a slot, e.g. `2024-01-31 00:00:00` or `2024-01-31`. '''
+    return date.fromisoformat(value[:10])
+
+# HH:MM with optional seconds, the hour may drop its leading zero, or HHMM
+TIME_OF_DAY = re.compile(r'(\d{1,2}):(\d{2})(?::\d{2})?|(\d{2})(\d{2})')
+
+def parse_minutes(value: str) -> int:
+    ''' Parse a time of day, e.g. `08:30`, `8:30`, `08:30:00` or `0830`, into minutes since midnight. '''
+    match = TIME_OF_DAY.fullmatch(value)
+    if match is None:
+        raise ValueError(f'Expected a time as HH:MM or HHMM, got: {value}')
+    hours, minutes = (int(group) for group in match.groups() if group is not None)
+    if hours > 23 or minutes > 59:
+        raise ValueError(f'Not a time of day: {value}')
+    return hours * 60 + minutes
+
+class ParsedTimes:
+    ''' The date and times of a slot parsed once on creation, so filtering and sorting don't re-parse the strings. '''
+    __slots__ = ('day', 'start_minutes', 'end_minutes')
+
+    def __post_init__(self):
+        self.day = parse_slot_date(self.slotRefDate)
+        self.start_minutes = parse_minutes(self.startTime)
+        self.end_minutes = parse_minutes(self.endTime)
 
 @dataclass
-class Slot:
+class Slot(ParsedTimes):
+    __slots__ = (
+        'slotId', 'slotIdEnc', 'slotRefName', 'slotRefDate', 'startTime', 'endTime',
+        'totalFee', 'userGroupNo', 'bookingProgress', 'bookingProgressEnc',
+    )
     slotId: int
     slotIdEnc: str
     slotRefName: str
@@ -42,7 +84,11 @@ class Slot:
         return f'{self.slotRefName} on {self.slotRefDate} from {self.startTime} to {self.endTime}, costing ${self.totalFee}.'
 
 @dataclass
-class BookedSlot:
+class BookedSlot(ParsedTimes):
+    __slots__ = (
+        'bookingId', 'theoryType', 'dataType', 'slotRefName', 'slotRefDesc', 'slotRefDate',
+        'startTime', 'endTime', 'totalFee', 'userGroupNo',
+    )
     bookingId: int
     theoryType: str
     dataType: str
@@ -72,11 +118,53 @@ class BookedSlot:
     def __str__(self):
         return f'[Booked] {self.slotRefName} on {self.slotRefDate} from {self.startTime} to {self.endTime}, costing ${self.totalFee}.'
 
-class Agent:
+def parse_booking_results(slots: list, res: dict) -> dict:
+    ''' Get whether each slot id was booked from a successful booking response. '''
+    results = {slot.slotId: True for slot in slots}
+    # a partially successful batch lists the outcome of each slot
+    data = res.get('data') or {}
+    reported = set()
+    for entry in data.get('bookedPracticalSlotList') or []:
+        slot_id = entry.get('slotId')
+        if slot_id in results:
+            # a slot sent twice is listed twice, and booked if either went through
+            results[slot_id] = bool(entry.get('success', True)) or (slot_id in reported and results[slot_id])
+            reported.add(slot_id)
+    return results
 
-    def __init__(self, logger: Logger):
-        self.__ocr_solver = OCRSolver()
-        self.__logger = logger
+# the BBDC API, or a stand-in such as mock_server.py
+BASE_URL = 'https://booking.bbdc.sg/bbdc-back-service/api'
+
+def create_session(pool_size: int = 10, retries: int = 3) -> requests.Session:
+    ''' Create a keep-alive session with a connection pool that retries failed connects. '''
+    session = requests.Session()
+    # only connection errors are retried, the request has not reached the server so it is safe to resend a POST
+    retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=0.2)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+class AgentBase:
+    ''' The request payloads, response handling and session bookkeeping shared by `Agent` and `AsyncAgent`.
+
+    The subclasses only add the transport, sending the requests these methods build and feeding the responses back.
+    '''
+
+    def __init__(self, logger: Logger, base_url: str = BASE_URL, ocr_solver: OCRSolver = None):
+        self.base_url = base_url
+        self._logger = logger
+        self._ocr_solver = ocr_solver if ocr_solver is not None else OCRSolver()
+        self._captcha_pool = None
+        # (size, ttl) of a captcha pool waiting for a session to start
+        self._pending_captcha_pool = None
+        self._captcha_corpus = None
+        self._tokens = TokenManager()
+        self._booked_slots = BookedSlotCache()
+        self._restored_captchas = []
+        # the outcome of the last login, shared with the callers that waited for it
+        self._last_login = None
+        self.expired_sessions = 0
 
     headers = {
         'authority': 'booking.bbdc.sg',
@@ -94,133 +182,254 @@ class Agent:
         'sec-fetch-site': 'same-origin',
         'user-agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36     (KHTML, like Gecko) Chrome/85.0.4183.102 Safari/537.36'
     }
-    authorization_token = ''
-    course_authorization_token = ''
+    # unsigned requests (the login flow) are sent without the session's auth header
+    unsigned_headers = {'authorization': None, 'jsessionid': ''}
+    # the share of the OCR variants' weight backing each character, calibrate with `benchmark.py calibrate`
+    min_captcha_confidence = 0.5
+    # fresh captchas to try when a booking is refused for a wrong captcha answer
+    booking_captcha_tries = 3
+    # how the server words a refused captcha answer, in lower case
+    captcha_rejection_messages = ('verification code', 'captcha')
     saved_username = ''
     saved_password = ''
 
-    def __debug(self, msg: str):
-        ''' Log a debug message. '''
-        self.__logger.debug(msg)
-    
-    def __info(self, msg: str):
-        ''' Log an info message. '''
-        self.__logger.info(msg)
+    @property
+    def tokens(self) -> TokenManager:
+        return self._tokens
 
-    def __warn(self, msg: str):
-        ''' Log a warning message. '''
-        self.__logger.warning(msg)
-    
-    def __error(self, msg: str):
-        ''' Log an error message. '''
-        self.__logger.error(msg)
+    @property
+    def booked_slots(self) -> BookedSlotCache:
+        return self._booked_slots
 
-    def __get_tmp_file_path(self):
-        ''' Get the path to the temporary file. '''
-        return '/tmp/bbdc_captcha.png'
+    @property
+    def captcha_pool(self) -> CaptchaPool:
+        return self._captcha_pool
 
-    def solve_captcha(self, captcha_type: str, tries: int = 10):
-        ''' Attempt to pass the captcha, returning the captcha data and token. '''
+    def _debug(self, msg: str, *args):
+        ''' Log a debug message, formatted with `args` only if it is emitted. '''
+        self._logger.debug(msg, *args)
+
+    def _info(self, msg: str, *args):
+        ''' Log an info message, formatted with `args` only if it is emitted. '''
+        self._logger.info(msg, *args)
+
+    def _warn(self, msg: str, *args):
+        ''' Log a warning message, formatted with `args` only if it is emitted. '''
+        self._logger.warning(msg, *args)
+
+    def _error(self, msg: str, *args):
+        ''' Log an error message, formatted with `args` only if it is emitted. '''
+        self._logger.error(msg, *args)
+
+    def set_credentials(self, username: str, password: str):
+        ''' Save the credentials to log in with once a session is first needed. '''
+        self.saved_username = username
+        self.saved_password = password
+
+    def export_state(self) -> dict:
+        ''' Get the session state worth keeping across restarts. '''
+        return {
+            'authorizationToken': self.authorization_token,
+            'courseAuthorizationToken': self.course_authorization_token,
+            'tokensIssuedAt': self._tokens.issued_at,
+            'tokensMaxAge': self._tokens.max_age,
+            # the tokens are the learner's, a restart with another username must not use them
+            'savedUsername': self.saved_username,
+            'captchas': self._captcha_pool.export() if self._captcha_pool is not None else self._restored_captchas,
+        }
+
+    def restore_state(self, state: dict):
+        ''' Restore a saved session, the tokens are only validated when first used.
+
+        Nothing is restored if the session was saved for another username than the one now set.
+        '''
+        if state.get('savedUsername') != self.saved_username:
+            self._warn('Not restoring the session state, it was saved for another username.')
+            return
+        self.authorization_token = state['authorizationToken']
+        self.course_authorization_token = state['courseAuthorizationToken']
+        self._tokens.max_age = state['tokensMaxAge']
+        if state['tokensIssuedAt'] is not None:
+            self._tokens.mark_restored(state['tokensIssuedAt'])
+        # handed to the captcha pool when it starts
+        self._restored_captchas = state['captchas']
+        self._info(f'Restored session state, token age: {self._tokens.age or 0:.0f}s, captchas: {len(self._restored_captchas)}.')
+
+    def record_captchas(self, directory: str):
+        ''' Record every captcha, its answer and the server's verdict into a corpus for offline benchmarking. '''
+        self._info(f'Recording captchas to {directory}.')
+        solver = f'{self._ocr_solver.describe()}, min confidence {self.min_captcha_confidence}'
+        self._captcha_corpus = CaptchaCorpus(directory, solver=solver)
+
+    def _record_verdict(self, captcha_data: dict, res: dict):
+        ''' Record the server's verdict on a submitted captcha answer. '''
+        if self._captcha_corpus is None or 'recordId' not in captcha_data:
+            return
+        self._captcha_corpus.record_verdict(captcha_data['recordId'], res['success'], res['message'])
+
+    def _captcha_url(self, captcha_type: str) -> str:
         assert captcha_type in ['login', 'booking']
-        self.__info(f'Solving captcha..., type: {captcha_type}, tries: {tries}.')
-        login_captcha_url = 'https://booking.bbdc.sg/bbdc-back-service/api/auth/getLoginCaptchaImage'
-        booking_captcha_url = 'https://booking.bbdc.sg/bbdc-back-service/api/booking/manage/getCaptchaImage'
-        for i in range(tries):
-            self.__info('Captcha attempt #' + str(i + 1))
-            # get captcha image and save to disk
-            if captcha_type == 'login':
-                res = requests.post(login_captcha_url, headers=self.headers).json()
-            else:
-                res = self.post_signed(booking_captcha_url, {})
-            if not res['success']:
-                self.__warn('Failed to get captcha. Error: ' + res['message'])
-                continue
-            data = res['data']
-            base64_image = data['image']
-            with open(self.__get_tmp_file_path(), 'wb') as f:
-                f.write(base64.b64decode(base64_image.replace('data:image/png;base64,', '')))
-            # solve captcha
-            answer = self.__ocr_solver.solve(self.__get_tmp_file_path())
-            if len(answer) != 5:
-                self.__warn('Improper captcha answer: ' + answer)
-                continue
-            data['answer'] = answer
-            self.__info('Captcha solved (probably).')
-            del data['image']
-            self.__debug(pformat(data, indent=4))
-            return data
-        self.__error('Failed to solve captcha.')
+        if captcha_type == 'login':
+            return f'{self.base_url}/auth/getLoginCaptchaImage'
+        return f'{self.base_url}/booking/manage/getCaptchaImage'
 
-    def authenticate(self, username: str, password: str, tries: int = 10):
-        ''' Authenticate to the website. '''
-        self.__info(f'Authenticating..., username: {username}, tries: {tries}.')
-        login_url = 'https://booking.bbdc.sg/bbdc-back-service/api/auth/login'
-        for i in range(tries):
-            self.__info('Authenticate attempt #' + str(i + 1))
-            # solve captcha
-            captcha_data = self.solve_captcha('login')
-            # authenticate
-            payload = {
-                'captchaToken': captcha_data['captchaToken'],
-                'userId': username,
-                'userPass': password,
-                'verifyCodeId': captcha_data['verifyCodeId'],
-                'verifyCodeValue': captcha_data['answer']
-            }
-            res = requests.post(login_url, headers=self.headers, json=payload).json()
-            if not res['success']:
-                self.__warn('Failed to authenticate. Error: ' + res['message'])
-                continue
-            self.authorization_token = res['data']['tokenContent']
-            self.__info('Successfully authenticated as ' + res['data']['username'])
-            # save credentials for reauthentication
-            self.saved_username = username
-            self.saved_password = password
-            # get course authorization token
-            self.get_course_authorization_token()
-            return res['data']['username']
-        return None
-        
-    def get_course_authorization_token(self):
-        self.__info('Getting course authorization token...')
-        url = 'https://booking.bbdc.sg/bbdc-back-service/api/account/listAccountCourseType'
-        payload = {}
-        res = self.post_signed(url, payload)
+    def _decode_captcha(self, res: dict):
+        ''' Get the image bytes of a fetched captcha, or None if the fetch failed. '''
         if not res['success']:
-            self.__error('Failed to get course authorization token. Error: ' + res['message'])
+            self._warn('Failed to get captcha. Error: ' + res['message'])
+            return None
+        with metrics.time('captcha_decode'):
+            return base64.b64decode(res['data']['image'].replace('data:image/png;base64,', ''))
+
+    def _is_plausible_answer(self, answer: str, confidence: float) -> bool:
+        return len(answer) == 5 and confidence >= self.min_captcha_confidence
+
+    def _accept_captcha(self, res: dict, image: bytes, captcha_type: str, answer: str, confidence: float):
+        ''' Get the captcha data to submit with the answer, or None if the answer can't be right. '''
+        # the response may still be waiting to be rendered in the log, don't change it under the logger
+        data = dict(res['data'])
+        if self._captcha_corpus is not None:
+            data['recordId'] = self._captcha_corpus.record(image, captcha_type, answer, confidence)
+        if len(answer) != 5:
+            self._warn('Improper captcha answer: ' + answer)
+            return None
+        data['answer'] = answer
+        data['confidence'] = confidence
+        del data['image']
+        self._debug('%s', Payload(data))
+        return data
+
+    def _is_confident(self, captcha_data: dict) -> bool:
+        ''' Whether to submit the answer now, a likely wrong answer costs a server round trip so another captcha is fetched instead. '''
+        if captcha_data['confidence'] < self.min_captcha_confidence:
+            self._warn(f'Low confidence captcha answer: {captcha_data["answer"]}, confidence: {captcha_data["confidence"]:.2f}')
+            return False
+        self._info('Captcha solved (probably).')
+        return True
+
+    def _better_captcha(self, best: Optional[dict], captcha_data: dict) -> dict:
+        ''' Keep the more confident of two unsubmitted captchas, to fall back on once out of tries. '''
+        if best is None or captcha_data['confidence'] > best['confidence']:
+            return captcha_data
+        return best
+
+    def _fall_back_captcha(self, best: Optional[dict]):
+        ''' Get the best answer read when none was confident, rather than giving up on the captcha. '''
+        if best is None:
+            self._error('Failed to solve captcha.')
+            return None
+        self._warn(f'Out of captcha tries, submitting the best answer: {best["answer"]}, confidence: {best["confidence"]:.2f}')
+        return best
+
+    def start_captcha_pool(self, size: int = 2, ttl: float = 60):
+        ''' Keep a pool of solved booking captchas ready in the background, from when there is a session to solve them under.
+
+        Started before the first login, the pool's first solve would log in by itself.
+        '''
+        self.stop_captcha_pool()
+        if self._tokens.is_valid():
+            self._start_captcha_pool(size, ttl)
+        else:
+            self._info('Captcha pool will start after login.')
+            self._pending_captcha_pool = (size, ttl)
+
+    def _captcha_pool_solve(self):
+        ''' Get the callable the captcha pool's refill thread solves booking captchas with. '''
+        raise NotImplementedError
+
+    def _start_captcha_pool(self, size: int, ttl: float):
+        self._pending_captcha_pool = None
+        self._info(f'Starting captcha pool, size: {size}, ttl: {ttl}s.')
+        self._captcha_pool = CaptchaPool(self._captcha_pool_solve(), size=size, ttl=ttl, logger=self._logger)
+        self._captcha_pool.restore(self._restored_captchas)
+        self._restored_captchas = []
+        self._captcha_pool.start()
+
+    def _take_pooled_captcha(self):
+        ''' Take a solved booking captcha from the pool, or None if there is none. '''
+        if self._captcha_pool is None:
+            return None
+        captcha_data = self._captcha_pool.take()
+        if captcha_data is not None:
+            self._info('Using pooled booking captcha.')
+        else:
+            self._info('Captcha pool is empty, solving captcha now.')
+        return captcha_data
+
+    def _login_request(self, captcha_data: dict, username: str, password: str) -> tuple:
+        url = f'{self.base_url}/auth/login'
+        payload = {
+            'captchaToken': captcha_data['captchaToken'],
+            'userId': username,
+            'userPass': password,
+            'verifyCodeId': captcha_data['verifyCodeId'],
+            'verifyCodeValue': captcha_data['answer']
+        }
+        return url, payload
+
+    def _accept_login(self, captcha_data: dict, res: dict, username: str, password: str) -> bool:
+        ''' Take the tokens from a login response, returning whether the login succeeded. '''
+        self._record_verdict(captcha_data, res)
+        if not res['success']:
+            self._warn('Failed to authenticate. Error: ' + res['message'])
+            return False
+        self.authorization_token = res['data']['tokenContent']
+        self._tokens.mark_issued()
+        # pooled captchas were issued to the old session
+        self._restored_captchas = []
+        self._info('Successfully authenticated as ' + res['data']['username'])
+        # save credentials for reauthentication
+        self.saved_username = username
+        self.saved_password = password
+        return True
+
+    def _course_token_request(self) -> tuple:
+        return f'{self.base_url}/account/listAccountCourseType', {}
+
+    def _accept_course_token(self, res: dict):
+        if not res['success']:
+            self._error('Failed to get course authorization token. Error: ' + res['message'])
             return
         self.course_authorization_token = res['data']['activeCourseList'][0]['authToken']
-        self.__info('Successfully got course authorization token.')
-    
-    def reauthenticate(self):
-        ''' Reauthenticate using saved credentials. '''
-        self.__info('Reauthenticating...')
+        self._info('Successfully got course authorization token.')
+        # booking captchas are issued to the course session, only refill or start the pool once there is a new one
+        if self._captcha_pool is not None:
+            self._captcha_pool.clear()
+        elif self._pending_captcha_pool is not None:
+            self._start_captcha_pool(*self._pending_captcha_pool)
+
+    def _check_saved_credentials(self):
         if self.saved_username == '' or self.saved_password == '':
             raise Exception('No saved credentials to reauthenticate.')
-        self.authenticate(self.saved_username, self.saved_password)
-       
-    def post_signed(self, url: str, data: dict) -> dict:
-        ''' Post data to a signed endpoint. '''
-        self.__info(f'POST {url}')
-        headers = self.headers.copy()
-        headers['authorization'] = self.authorization_token
-        headers['jsessionid'] = self.course_authorization_token
-        cookies = {
-            'bbdc-token': self.authorization_token.replace(' ', '%20')
-        }
-        response = requests.post(url, headers=headers, json=data, cookies=cookies)
-        self.__debug(pformat(response, indent=4))
-        self.__debug(pformat(response.json(), indent=4))
-        if response.status_code == 402:
-            self.__info('Session expired. Re-authenticating...')
-            self.reauthenticate()
-            # retry request
-            return self.post_signed(url, data)
-        return response.json()
 
-    def api_list_c3_practical_slot_released(self, month: str = None):
-        ''' List all C3 practical trainings. '''
-        url = 'https://booking.bbdc.sg/bbdc-back-service/api/booking/c3practical/listC3PracticalSlotReleased'
+    def _seconds_until_refresh(self, retry_delay: float) -> float:
+        ''' Get how long the background refresh should wait before its next login, 0 to log in now. '''
+        delay = self._tokens.seconds_until_refresh()
+        if delay > 0:
+            return delay
+        if self.saved_username == '' or self._tokens.issued_at is None:
+            # no session to refresh, the first request logs in on demand
+            return retry_delay
+        return 0
+
+    def _record_login(self, username: str):
+        ''' Record the outcome of a login for the callers that waited on it. '''
+        self._last_login = username
+        self._tokens.record_login()
+
+    def _needs_login(self) -> bool:
+        ''' Whether a request should log in before it is sent, as the background refresh didn't get there in time. '''
+        return self.saved_username != '' and not self._tokens.is_valid()
+
+    def _record_expired_session(self, generation: int):
+        ''' Note a request sent with the tokens of `generation` was refused as expired. '''
+        self._info('Session expired. Re-authenticating...')
+        self.expired_sessions += 1
+        if generation == self._tokens.generation:
+            self._tokens.record_expiry()
+
+    def _released_slots_request(self, month: str = None) -> tuple:
+        url = f'{self.base_url}/booking/c3practical/listC3PracticalSlotReleased'
         data = {
             "courseType": "3A",
             "insInstructorId": "",
@@ -229,95 +438,429 @@ class Agent:
             "subVehicleType": None,
             "subStageSubNo": None,
         }
-        return self.post_signed(url, data)
-    
-    def get_available_practical_slots(self, maximum_months_into_future: int = 3):
-        ''' Check for available practical slots. '''
-        self.__info(f'Checking for available practical slots, maximum months into future: {maximum_months_into_future}.')
-        all_slots = []
-        for i in range(maximum_months_into_future):
-            self.__info(f'Checking {i} months into the future...')
-            month = (datetime.now() + relativedelta(months=i)).strftime('%Y%m')
-            res = self.api_list_c3_practical_slot_released(month)
-            if not res['success']:
-                self.__error('Failed to check available slots. Error: ' + res['message'])
-                continue
-            slots = res['data']['releasedSlotListGroupByDay']
-            if slots is None:
-                self.__info(f'No slots found in {month}.')
-                continue
-            slots = [Slot.from_dict(slot) for slot in sum(slots.values(), start=[])]
-            slots = [slot for slot in slots if slot.is_available()]
-            all_slots += slots
-            self.__info(f'Found {len(slots)} slots in {month}:')
-            self.__debug(pformat(slots, indent=4))
-        return all_slots
-    
-    def api_book_c3_practical_slot(self, captcha_data: dict, slot: Slot):
-        url = 'https://booking.bbdc.sg/bbdc-back-service/api/booking/c3practical/bookC3PracticalSlot'
+        return url, data
+
+    def _parse_released_slots(self, month: str, res: dict) -> list:
+        ''' Get the available slots from a month's listing. '''
+        if not res['success']:
+            self._error('Failed to check available slots. Error: ' + res['message'])
+            return []
+        slots = res['data']['releasedSlotListGroupByDay']
+        if slots is None:
+            self._info(f'No slots found in {month}.')
+            return []
+        slots = [Slot.from_dict(slot) for slot in itertools.chain.from_iterable(slots.values())]
+        slots = [slot for slot in slots if slot.is_available()]
+        self._info(f'Found {len(slots)} slots in {month}:')
+        self._debug('%s', Payload(slots))
+        return slots
+
+    def _months_into_future(self, maximum_months_into_future: int) -> list:
+        self._info(f'Checking for available practical slots, maximum months into future: {maximum_months_into_future}.')
+        return [(datetime.now() + relativedelta(months=i)).strftime('%Y%m') for i in range(maximum_months_into_future)]
+
+    @staticmethod
+    def _in_month_order(slots_by_month: dict) -> list:
+        # keep the listing in month order regardless of which month returned first
+        return list(itertools.chain.from_iterable(slots_by_month[month] for month in sorted(slots_by_month)))
+
+    def _book_request(self, captcha_data: dict, slots: list) -> tuple:
+        url = f'{self.base_url}/booking/c3practical/bookC3PracticalSlot'
         data = {
             'verifyCodeId': captcha_data['verifyCodeId'],
             'verifyCodeValue': captcha_data['answer'],
             'captchaToken': captcha_data['captchaToken'],
             'courseType': '3A',
             'cacheId': '', # a unique id to each type of booking, from listC3PracticalTrainings
-            'slotIdList': [slot.slotId],
+            'slotIdList': [slot.slotId for slot in slots],
             'encryptSlotList': [
                 {
                     'slotIdEnc': slot.slotIdEnc,
                     'bookingProgressEnc': slot.bookingProgressEnc
                 }
+                for slot in slots
             ]
         }
-        return self.post_signed(url, data)
-    
-    def book_practical_slot(self, slot: Slot):
-        ''' Book a practical slot. '''
-        self.__info(f'Booking slot: {pformat(slot, indent=4)}.')
-        # solve captcha
-        captcha_data = self.solve_captcha('booking')
-        # book slot
-        res = self.api_book_c3_practical_slot(captcha_data, slot)
-        if not res['success']:
-            self.__error('Failed to book slot. Error: ' + res['message'])
+        return url, data
+
+    def _is_captcha_rejection(self, res: dict) -> bool:
+        message = (res.get('message') or '').lower()
+        return not res['success'] and any(marker in message for marker in self.captcha_rejection_messages)
+
+    def _retry_captcha(self, captcha_data: dict, res: dict, attempt: int) -> bool:
+        ''' Whether to send the batch again with a fresh captcha, as the server refused the captcha answer rather than a slot. '''
+        if not self._is_captcha_rejection(res) or attempt + 1 >= self.booking_captcha_tries:
             return False
-        self.__info('Successfully booked slot.')
+        self._record_verdict(captcha_data, res)
+        self._warn(f'Captcha answer refused, retrying with a fresh captcha. Error: {res["message"]}')
         return True
-    
-    def api_list_booked_c3_practical_slots(self, month: str = None):
-        url = 'https://booking.bbdc.sg/bbdc-back-service/api/booking/manage/listAllPracticalBooking'
+
+    def _parse_booking(self, captcha_data: dict, slots: list, res: dict):
+        ''' Get whether each slot id was booked, or None if the batch was refused and each half should be retried on its own. '''
+        self._record_verdict(captcha_data, res)
+        if not res['success']:
+            self._error('Failed to book slots. Error: ' + res['message'])
+            # a refused captcha says nothing about the slots, splitting wouldn't help
+            if len(slots) == 1 or self._is_captcha_rejection(res):
+                return {slot.slotId: False for slot in slots}
+            # the server may have rejected the batch for one bad slot
+            self._info(f'Splitting batch of {len(slots)} slots.')
+            return None
+        results = parse_booking_results(slots, res)
+        self._info(f'Booked {sum(results.values())} of {len(slots)} slots.')
+        return results
+
+    @staticmethod
+    def _halves(slots: list) -> tuple:
+        half = len(slots) // 2
+        return slots[:half], slots[half:]
+
+    def _record_booking_results(self, results: dict):
+        if any(results.values()):
+            self._booked_slots.record_bookings(sum(results.values()))
+
+    def _booked_slots_request(self) -> tuple:
+        url = f'{self.base_url}/booking/manage/listAllPracticalBooking'
         data = {
             'courseType': '3A'
         }
-        return self.post_signed(url, data)
-    
-    def get_all_booked_slots(self):
-        ''' Get all booked slots. '''
-        self.__info('Getting all booked slots...')
-        res = self.api_list_booked_c3_practical_slots()
+        return url, data
+
+    def _parse_booked_slots(self, res: dict, version: int) -> Optional[list]:
+        ''' Get the booked slots from a listing requested at cache `version`, caching them, or None if the listing failed. '''
         if not res['success']:
-            self.__error('Failed to get all booked slots. Error: ' + res['message'])
-            return []
+            self._error('Failed to get all booked slots. Error: ' + res['message'])
+            return None
         slots = [BookedSlot.from_dict(slot) for slot in res['data']['theoryActiveBookingList']]
-        self.__info(f'Got {len(slots)} booked slots:')
-        self.__debug(pformat(slots, indent=4))
+        self._booked_slots.store(slots, version)
+        self._info(f'Got {len(slots)} booked slots:')
+        self._debug('%s', Payload(slots))
         return slots
-    
-    def api_cancel_c3_practical_slot(self, slot: BookedSlot):
-        url = 'https://booking.bbdc.sg/bbdc-back-service/api/booking/manage/cancelBooking'
+
+    def _cancel_request(self, slot: BookedSlot) -> tuple:
+        url = f'{self.base_url}/booking/manage/cancelBooking'
         data = {
             'bookingId': slot.bookingId,
             'theoryType': slot.theoryType,
             'manageType': slot.dataType,
         }
-        return self.post_signed(url, data)
-    
-    def cancel_practical_slot(self, slot: BookedSlot):
-        ''' Cancel a practical slot. '''
-        self.__info(f'Cancelling slot: {pformat(slot, indent=4)}.')
-        res = self.api_cancel_c3_practical_slot(slot)
+        return url, data
+
+    def _parse_cancellation(self, slot: BookedSlot, res: dict) -> bool:
         if not res['success']:
-            self.__error('Failed to cancel slot. Error: ' + res['message'])
+            self._error('Failed to cancel slot. Error: ' + res['message'])
             return False
-        self.__info('Successfully cancelled slot.')
-        return True
\ No newline at end of file
+        self._booked_slots.record_cancellation(slot.bookingId)
+        self._info('Successfully cancelled slot.')
+        return True
+
+    @staticmethod
+    def _unique_slots(slots: list) -> list:
+        # a slot sent twice would be booked once and reported as failed once
+        return list({slot.slotId: slot for slot in slots}.values())
+
+    @staticmethod
+    def _unique_bookings(slots: list) -> list:
+        # a booking cancelled twice would fail the second time
+        return list({slot.bookingId: slot for slot in slots}.values())
+
+class Agent(AgentBase):
+
+    def __init__(self, logger: Logger, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 20,
+                 base_url: str = BASE_URL, ocr_solver: OCRSolver = None):
+        self.__session = create_session(pool_size)
+        self.__session.headers.update(self.headers)
+        super().__init__(logger, base_url, ocr_solver)
+        self.timeout = (connect_timeout, read_timeout)
+        self.authorization_token = ''
+        self.course_authorization_token = ''
+        self.__reauth_lock = threading.Lock()
+        self.__refresh_thread = None
+        self.__refresh_stopped = threading.Event()
+
+    @property
+    def authorization_token(self) -> str:
+        return self.__authorization_token
+
+    @authorization_token.setter
+    def authorization_token(self, token: str):
+        ''' Set the token and the session's auth header and cookie along with it. '''
+        self.__authorization_token = token
+        self.__session.headers['authorization'] = token
+        self.__session.cookies.set('bbdc-token', token.replace(' ', '%20'))
+
+    @property
+    def course_authorization_token(self) -> str:
+        return self.__course_authorization_token
+
+    @course_authorization_token.setter
+    def course_authorization_token(self, token: str):
+        self.__course_authorization_token = token
+        self.__session.headers['jsessionid'] = token
+
+    def __post_unsigned(self, url: str, data: dict = None) -> dict:
+        ''' Post data to an endpoint of the login flow, without the auth header. '''
+        return self.__session.post(url, headers=self.unsigned_headers, json=data, timeout=self.timeout).json()
+
+    def solve_captcha(self, captcha_type: str, tries: int = 10):
+        ''' Attempt to pass the captcha, returning the captcha data and token. '''
+        self._info(f'Solving captcha..., type: {captcha_type}, tries: {tries}.')
+        url = self._captcha_url(captcha_type)
+        with metrics.time('captcha_solve', type=captcha_type) as solve_timer:
+            # issued captchas stay valid until used, the best low confidence one is submitted if none is confident
+            best = None
+            for i in range(tries):
+                self._info('Captcha attempt #' + str(i + 1))
+                # get captcha image
+                with metrics.time('captcha_fetch', type=captcha_type) as timer:
+                    if captcha_type == 'login':
+                        res = self.__post_unsigned(url)
+                    else:
+                        res = self.post_signed(url, {})
+                    timer.success = res['success']
+                image = self._decode_captcha(res)
+                if image is None:
+                    continue
+                # solve captcha
+                with metrics.time('captcha_ocr') as timer:
+                    answer, confidence = self._ocr_solver.solve(image, length=5)
+                    timer.success = self._is_plausible_answer(answer, confidence)
+                captcha_data = self._accept_captcha(res, image, captcha_type, answer, confidence)
+                if captcha_data is None:
+                    continue
+                if self._is_confident(captcha_data):
+                    return captcha_data
+                best = self._better_captcha(best, captcha_data)
+            solve_timer.success = best is not None
+            return self._fall_back_captcha(best)
+
+    def _captcha_pool_solve(self):
+        return lambda: self.solve_captcha('booking')
+
+    def stop_captcha_pool(self):
+        ''' Stop the booking captcha pool, if running. '''
+        self._pending_captcha_pool = None
+        if self._captcha_pool is not None:
+            self._captcha_pool.stop()
+            self._captcha_pool = None
+
+    def take_booking_captcha(self):
+        ''' Take a solved booking captcha from the pool, solving one now if the pool is empty. '''
+        captcha_data = self._take_pooled_captcha()
+        if captcha_data is not None:
+            return captcha_data
+        return self.solve_captcha('booking')
+
+    def authenticate(self, username: str, password: str, tries: int = 10):
+        ''' Authenticate to the website. '''
+        self._info(f'Authenticating..., username: {username}, tries: {tries}.')
+        with metrics.time('auth') as timer:
+            for i in range(tries):
+                self._info('Authenticate attempt #' + str(i + 1))
+                # solve captcha
+                captcha_data = self.solve_captcha('login')
+                if captcha_data is None:
+                    continue
+                # authenticate
+                url, payload = self._login_request(captcha_data, username, password)
+                with metrics.time('request', endpoint=endpoint_name(url)) as request_timer:
+                    res = self.__post_unsigned(url, payload)
+                    request_timer.success = bool(res.get('success'))
+                if not self._accept_login(captcha_data, res, username, password):
+                    continue
+                # get course authorization token
+                self.get_course_authorization_token()
+                return res['data']['username']
+            timer.success = False
+            return None
+
+    def get_course_authorization_token(self):
+        self._info('Getting course authorization token...')
+        url, payload = self._course_token_request()
+        # part of the login flow, an expired session here must not trigger another login
+        self._accept_course_token(self.post_signed(url, payload, retries=0))
+
+    def reauthenticate(self, logins: int = None):
+        ''' Reauthenticate using saved credentials, concurrent callers share a single login.
+
+        A caller passing the login count (`tokens.logins`) its request was sent with skips the login if one has finished since,
+        sharing its outcome, so a failing login is not retried by every caller in turn.
+        '''
+        self._check_saved_credentials()
+        if logins is None:
+            logins = self._tokens.logins
+        with self.__reauth_lock:
+            # someone else tried to log in while we waited for the lock
+            if logins != self._tokens.logins:
+                return self._last_login
+            self._info('Reauthenticating...')
+            with metrics.time('reauth') as timer:
+                username = self.authenticate(self.saved_username, self.saved_password)
+                timer.success = username is not None
+            self._record_login(username)
+            return username
+
+    def start_token_refresh(self, retry_delay: float = 60):
+        ''' Refresh the tokens in the background ahead of their expiry. '''
+        self.stop_token_refresh()
+        self.__refresh_stopped.clear()
+        self.__refresh_thread = threading.Thread(target=self.__refresh_tokens, args=(retry_delay,), name='token-refresh', daemon=True)
+        self.__refresh_thread.start()
+
+    def stop_token_refresh(self):
+        if self.__refresh_thread is not None:
+            self.__refresh_stopped.set()
+            self.__refresh_thread.join()
+            self.__refresh_thread = None
+
+    def __refresh_tokens(self, retry_delay: float):
+        while not self.__refresh_stopped.is_set():
+            delay = self._seconds_until_refresh(retry_delay)
+            if delay > 0:
+                self.__refresh_stopped.wait(delay)
+                continue
+            self._info('Refreshing tokens ahead of expiry...')
+            try:
+                username = self.reauthenticate()
+            except Exception:
+                self._logger.exception('Failed to refresh tokens.')
+                username = None
+            if username is None:
+                self.__refresh_stopped.wait(retry_delay)
+
+    def post_signed(self, url: str, data: dict, retries: int = 2) -> dict:
+        ''' Post data to a signed endpoint, reauthenticating at most `retries` times in all if the session has expired. '''
+        reauths = 0
+        while True:
+            if reauths < retries and self._needs_login():
+                # the background refresh didn't get there in time
+                reauths += 1
+                if self.reauthenticate() is None:
+                    # a failed login is not retried within the same request
+                    reauths = retries
+            self._info(f'POST {url}')
+            generation, logins = self._tokens.generation, self._tokens.logins
+            # the auth headers and cookie are kept on the session
+            with metrics.time('request', endpoint=endpoint_name(url)) as timer:
+                response = self.__session.post(url, json=data, timeout=self.timeout)
+                res = response.json()
+                timer.success = response.status_code == 200 and bool(res.get('success'))
+            self._debug('%s %s', response, Payload(res))
+            if response.status_code != 402:
+                self._tokens.confirm()
+                return res
+            if reauths >= retries:
+                return res
+            self._record_expired_session(generation)
+            reauths += 1
+            if self.reauthenticate(logins) is None:
+                return res
+            # retry request
+
+    def api_list_c3_practical_slot_released(self, month: str = None):
+        ''' List all C3 practical trainings. '''
+        return self.post_signed(*self._released_slots_request(month))
+
+    def __iter_released_months(self, maximum_months_into_future: int, max_concurrency: int):
+        ''' Query the months concurrently, yielding each month's available slots as soon as its listing returns. '''
+        with metrics.time('scan'):
+            months = self._months_into_future(maximum_months_into_future)
+            with ThreadPoolExecutor(max_concurrency) as executor:
+                futures = {executor.submit(self.api_list_c3_practical_slot_released, month): month for month in months}
+                for future in as_completed(futures):
+                    month = futures[future]
+                    yield month, self._parse_released_slots(month, future.result())
+
+    def iter_available_practical_slots(self, maximum_months_into_future: int = 3, max_concurrency: int = 3):
+        ''' Check for available practical slots, yielding them as soon as their month's listing returns. '''
+        for month, slots in self.__iter_released_months(maximum_months_into_future, max_concurrency):
+            yield from slots
+
+    def get_available_practical_slots(self, maximum_months_into_future: int = 3, max_concurrency: int = 3):
+        ''' Check for available practical slots, querying the months concurrently. '''
+        return self._in_month_order(dict(self.__iter_released_months(maximum_months_into_future, max_concurrency)))
+
+    def api_book_c3_practical_slot(self, captcha_data: dict, slot: Slot):
+        return self.api_book_c3_practical_slots(captcha_data, [slot])
+
+    def api_book_c3_practical_slots(self, captcha_data: dict, slots: list):
+        ''' Book several slots in one request, behind one captcha. '''
+        if captcha_data is None:
+            captcha_data = self.take_booking_captcha()
+        return self.post_signed(*self._book_request(captcha_data, slots))
+
+    def book_practical_slot(self, slot: Slot):
+        ''' Book a practical slot. '''
+        results = self.book_practical_slots([slot])
+        return results[slot.slotId]
+
+    def book_practical_slots(self, slots: list) -> dict:
+        ''' Book several practical slots under one captcha, returning whether each slot id was booked. '''
+        slots = self._unique_slots(slots)
+        with metrics.time('book') as timer:
+            results = self.__book_practical_slots(slots)
+            timer.success = all(results.values())
+        self._record_booking_results(results)
+        return results
+
+    def __book_practical_slots(self, slots: list) -> dict:
+        self._info('Booking %d slots: %s.', len(slots), Payload(slots))
+        for attempt in range(self.booking_captcha_tries):
+            # take a pre-solved captcha if available
+            captcha_data = self.take_booking_captcha()
+            if captcha_data is None:
+                self._error('Failed to book slots. Could not solve captcha.')
+                return {slot.slotId: False for slot in slots}
+            # book slots
+            res = self.api_book_c3_practical_slots(captcha_data, slots)
+            if not self._retry_captcha(captcha_data, res, attempt):
+                break
+        results = self._parse_booking(captcha_data, slots, res)
+        if results is None:
+            results = {}
+            for half in self._halves(slots):
+                results.update(self.__book_practical_slots(half))
+        return results
+
+    def api_list_booked_c3_practical_slots(self, month: str = None):
+        return self.post_signed(*self._booked_slots_request())
+
+    def get_all_booked_slots(self, max_age: float = None) -> Optional[list]:
+        ''' Get all booked slots, from the cache if listed within `max_age` seconds (default: the cache's ttl), or None if they could not be listed. '''
+        slots = self._booked_slots.get(max_age)
+        if slots is not None:
+            return slots
+        self._info('Getting all booked slots...')
+        version = self._booked_slots.begin_listing()
+        return self._parse_booked_slots(self.api_list_booked_c3_practical_slots(), version)
+
+    def count_booked_slots(self) -> Optional[int]:
+        ''' Get the number of slots held, without a request while the cache is fresh, or None if they could not be listed. '''
+        count = self._booked_slots.count()
+        if count is None:
+            slots = self.get_all_booked_slots()
+            count = None if slots is None else len(slots)
+        return count
+
+    def api_cancel_c3_practical_slot(self, slot: BookedSlot):
+        return self.post_signed(*self._cancel_request(slot))
+
+    def cancel_practical_slot(self, slot: BookedSlot):
+        ''' Cancel a practical slot. '''
+        self._info('Cancelling slot: %s.', Payload(slot))
+        return self._parse_cancellation(slot, self.api_cancel_c3_practical_slot(slot))
+
+    def cancel_practical_slots(self, slots: list, max_concurrency: int = 3) -> dict:
+        ''' Cancel several practical slots concurrently, returning whether each booking id was cancelled. '''
+        slots = self._unique_bookings(slots)
+        with ThreadPoolExecutor(max_concurrency) as executor:
+            futures = {slot.bookingId: executor.submit(self.cancel_practical_slot, slot) for slot in slots}
+        results = {}
+        for booking_id, future in futures.items():
+            # one failed cancel doesn't stop the others
+            try:
+                results[booking_id] = future.result()
+            except Exception:
+                self._logger.exception(f'Failed to cancel slot {booking_id}.')
+                results[booking_id] = False
+        return results
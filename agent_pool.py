@@ -0,0 +1,196 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from logging import Logger
+from typing import Awaitable, Callable, Optional
+
+from agent import BASE_URL
+from async_agent import AsyncAgent
+from booking_rules import RuleSet
+from metrics import metrics
+from ocr_solver import OCRSolver
+from scheduler import AdaptiveScheduler
+from slot_index import SlotIndex
+
+class RateLimiter:
+    ''' A token bucket allowing `per_minute` requests a minute, in bursts of up to `burst`. '''
+
+    def __init__(self, per_minute: float, burst: int = None):
+        self.per_minute = per_minute
+        self.burst = burst if burst is not None else max(1, int(per_minute // 6))
+        self.__tokens = float(self.burst)
+        self.__updated_at = time.monotonic()
+        self.__lock = asyncio.Lock()
+
+    async def acquire(self):
+        ''' Wait until a request may be sent. '''
+        async with self.__lock:
+            while True:
+                now = time.monotonic()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__updated_at) * self.per_minute / 60)
+                self.__updated_at = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.__tokens) * 60 / self.per_minute)
+
+@dataclass
+class Account:
+    ''' A learner's account with everything the bot keeps for it. '''
+    name: str
+    agent: AsyncAgent
+    scheduler: AdaptiveScheduler
+    chat_id: Optional[int] = None
+    scanning: bool = False
+    next_scan_at: float = 0
+    # whether a scan has listed the slots since starting, the first one finds everything released while the bot was away
+    scanned: bool = False
+    slot_index: SlotIndex = field(default_factory=SlotIndex)
+    rules: RuleSet = field(default_factory=RuleSet)
+    # the listing last shown to the chat, numbered for /delete
+    booked_slots: list = field(default_factory=list)
+    autobook_history: deque = field(default_factory=lambda: deque(maxlen=50))
+    autobook_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+class AgentPool:
+    ''' Many accounts in one process, sharing the OCR workers and a global request rate limit.
+
+    A single loop spreads the accounts' slot scans out in time, each account scanning on its own adaptive schedule.
+    '''
+
+    def __init__(self, logger: Logger, months_into_future: int = 3, global_requests_per_minute: float = 60,
+                 account_requests_per_minute: float = 12, booking_requests_per_minute: float = 6, base_url: str = BASE_URL):
+        self.__logger = logger
+        self.base_url = base_url
+        self.months_into_future = months_into_future
+        self.account_requests_per_minute = account_requests_per_minute
+        self.global_requests_per_minute = global_requests_per_minute
+        self.booking_requests_per_minute = booking_requests_per_minute
+        self.__global_limiter = RateLimiter(global_requests_per_minute, self.__burst(global_requests_per_minute))
+        # one set of OCR worker processes for every account
+        self.__ocr_solver = OCRSolver()
+        self.__accounts = {}
+        self.__scan_task = None
+        self.__running_scans = set()
+        # the event loop only keeps weak references to tasks, hold the running scans until they finish
+        self.__scan_account_tasks = set()
+        self.__wakeup = asyncio.Event()
+
+    def __iter__(self):
+        return iter(self.__accounts.values())
+
+    def __len__(self):
+        return len(self.__accounts)
+
+    def __burst(self, per_minute: float) -> int:
+        # a scan's months are listed at once, a smaller burst would serialise them
+        return max(self.months_into_future, int(per_minute // 6))
+
+    def add_account(self, name: str, username: str, password: str, chat_id: int = None) -> Account:
+        ''' Add an account, logging in to it is deferred until its first request.
+
+        Booking on demand has its own allowance outside of the scan and global limits, two requests (the captcha and the booking)
+        for each batch, so a booking never waits behind the scans.
+        '''
+        limiter = RateLimiter(self.account_requests_per_minute, self.__burst(self.account_requests_per_minute))
+        agent = AsyncAgent(
+            self.__logger.getChild(name),
+            ocr_solver=self.__ocr_solver,
+            rate_limiters=[limiter, self.__global_limiter],
+            booking_rate_limiters=[RateLimiter(self.booking_requests_per_minute, burst=4)],
+            base_url=self.base_url,
+        )
+        agent.set_credentials(username, password)
+        scheduler = AdaptiveScheduler(max_requests_per_minute=self.account_requests_per_minute, requests_per_scan=self.months_into_future)
+        account = Account(name=name, agent=agent, scheduler=scheduler, chat_id=chat_id)
+        self.__accounts[name] = account
+        return account
+
+    def get(self, name: str) -> Optional[Account]:
+        return self.__accounts.get(name)
+
+    def start_captcha_pool(self, account: Account, size: int = 2, ttl: float = 60):
+        ''' Keep the account's booking captchas topped up, leaving the requests it takes out of the account's scan budget. '''
+        account.agent.start_captcha_pool(size, ttl)
+        # each pooled captcha is fetched again once it expires
+        account.scheduler.background_requests_per_minute = size * 60 / ttl
+
+    def account_for_chat(self, chat_id: int) -> Optional[Account]:
+        ''' Get the account a chat is linked to. '''
+        for account in self.__accounts.values():
+            if account.chat_id == chat_id:
+                return account
+        return None
+
+    def start_scanning(self, account: Account, delay: float = 1):
+        ''' Include the account in the scan rotation. '''
+        account.scanning = True
+        account.next_scan_at = time.monotonic() + delay
+        self.__wakeup.set()
+
+    def stop_scanning(self, account: Account):
+        account.scanning = False
+
+    def start(self, scan: Callable[[Account], Awaitable[None]]):
+        ''' Start the scan loop, calling `scan` for each account when its next scan is due. Must be called from the event loop. '''
+        self.stop()
+        self.__scan_task = asyncio.create_task(self.__run_scans(scan))
+
+    def stop(self):
+        ''' Stop the scan loop and cancel the scans in flight. '''
+        if self.__scan_task is not None:
+            self.__scan_task.cancel()
+            self.__scan_task = None
+        for task in self.__scan_account_tasks:
+            task.cancel()
+
+    async def close(self):
+        ''' Stop scanning and close every account. '''
+        self.stop()
+        # let the cancelled scans unwind before their agents are closed
+        await asyncio.gather(*self.__scan_account_tasks, return_exceptions=True)
+        for account in self.__accounts.values():
+            await account.agent.close()
+        self.__ocr_solver.close()
+
+    def __scan_spacing(self) -> float:
+        ''' Seconds between scan starts that keeps back to back scans under the global rate. '''
+        return self.months_into_future * 60 / self.global_requests_per_minute
+
+    async def __run_scans(self, scan: Callable[[Account], Awaitable[None]]):
+        while True:
+            self.__wakeup.clear()
+            now = time.monotonic()
+            due = [
+                account for account in self.__accounts.values()
+                if account.scanning and account.next_scan_at <= now and account.name not in self.__running_scans
+            ]
+            # most overdue first, staggered so the accounts don't hit the server in bursts
+            for account in sorted(due, key=lambda account: account.next_scan_at):
+                self.__running_scans.add(account.name)
+                task = asyncio.create_task(self.__scan_account(account, scan))
+                self.__scan_account_tasks.add(task)
+                task.add_done_callback(self.__scan_account_tasks.discard)
+                await asyncio.sleep(self.__scan_spacing())
+            upcoming = [
+                account.next_scan_at for account in self.__accounts.values()
+                if account.scanning and account.name not in self.__running_scans
+            ]
+            timeout = max(0, min(upcoming) - time.monotonic()) if upcoming else None
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __scan_account(self, account: Account, scan: Callable[[Account], Awaitable[None]]):
+        try:
+            await scan(account)
+        except Exception:
+            self.__logger.exception(f'Scan failed for {account.name}.')
+        finally:
+            delay = account.scheduler.next_delay()
+            metrics.observe('scan_delay', delay)
+            account.next_scan_at = time.monotonic() + delay
+            self.__running_scans.discard(account.name)
+            self.__wakeup.set()
@@ -1,8 +1,10 @@
 import os
-import logging
+import time
 import traceback
 import html
 import json
+from datetime import datetime
+from typing import Optional
 
 from telegram import Update
 from telegram.ext import (
@@ -12,35 +14,111 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode
 
-from agent import Agent
-
-def get_logger(module_name: str):
-    log = logging.getLogger(module_name)
-    s_handler = logging.StreamHandler()
-    s_handler.setLevel(logging.DEBUG)
-    s_handler.setFormatter(logging.Formatter(f'[{module_name}] %(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
-    log.addHandler(s_handler)
-    f_handler = logging.FileHandler(f'bbdc_telebot_{module_name}.log')
-    f_handler.setLevel(logging.DEBUG)
-    f_handler.setFormatter(logging.Formatter(f'[{module_name}] %(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S'))
-    log.addHandler(f_handler)
-    log.setLevel(logging.DEBUG)
-    return log
+from agent import BASE_URL
+from agent_pool import Account, AgentPool
+from logs import get_logger
+from metrics import metrics
+from slot_index import SlotIndex
+from slot_store import parse_query
+from booking_rules import BookingRule, RuleSet
+from state_store import save_state, load_state
 
-agent_logger = get_logger('AGT')
-agent = Agent(agent_logger)
-userid = os.getenv('BBDCTELEBOTUSERID')
-password = os.getenv('BBDCTELEBOTPASSWORD')
-agent.authenticate(userid, password)
+started_at = time.perf_counter()
 
-my_chat_id = None
-all_booked_slots = []
+agent_logger = get_logger('AGT')
+pool = AgentPool(
+    agent_logger,
+    months_into_future=3,
+    global_requests_per_minute=float(os.getenv('BBDCTELEBOTGLOBALRPM', '60')),
+    account_requests_per_minute=float(os.getenv('BBDCTELEBOTMAXRPM', '12')),
+    # e.g. the stand-in started by mock_server.py
+    base_url=os.getenv('BBDCTELEBOTBASEURL', BASE_URL),
+)
+state_file = os.getenv('BBDCTELEBOTSTATEFILE', 'bbdc_telebot_state.json')
+metrics_server = None
 
 app_logger = get_logger('APP')
 
+def add_accounts() -> None:
+    ''' Add the configured accounts to the pool.
+
+    Called from `main` rather than on import, as the OCR worker processes import this module again when they start.
+    '''
+    if os.getenv('BBDCTELEBOTACCOUNTS'):
+        # a JSON list of {"name", "username", "password", "chatId"}, one per learner
+        with open(os.getenv('BBDCTELEBOTACCOUNTS')) as f:
+            for entry in json.load(f):
+                pool.add_account(entry['name'], entry['username'], entry['password'], entry.get('chatId'))
+    else:
+        # a single account, linked to whoever sends /start
+        pool.add_account('default', os.getenv('BBDCTELEBOTUSERID'), os.getenv('BBDCTELEBOTPASSWORD'))
+    if os.getenv('BBDCTELEBOTCAPTCHACONFIDENCE'):
+        # as suggested by `benchmark.py calibrate` on a recorded corpus
+        for account in pool:
+            account.agent.min_captcha_confidence = float(os.getenv('BBDCTELEBOTCAPTCHACONFIDENCE'))
+    if os.getenv('BBDCTELEBOTCAPTCHACORPUS'):
+        for account in pool:
+            account.agent.record_captchas(os.path.join(os.getenv('BBDCTELEBOTCAPTCHACORPUS'), account.name))
+
+def save_app_state() -> None:
+    ''' Save every account's session, slot index, rules and release windows so a restart can pick up where it left off. '''
+    accounts = {}
+    for account in pool:
+        accounts[account.name] = {
+            'agent': account.agent.export_state(),
+            'chatId': account.chat_id,
+            'scanning': account.scanning,
+            'slotIndex': account.slot_index.export(),
+            'rules': account.rules.export(),
+            'scheduler': account.scheduler.export_state(),
+        }
+    save_state(state_file, {'accounts': accounts})
+
+def restore_app_state() -> None:
+    ''' Restore the saved state and resume the scans that were running. '''
+    state = load_state(state_file)
+    if state is None:
+        return
+    for name, saved in state.get('accounts', {}).items():
+        account = pool.get(name)
+        if account is None:
+            # the account was removed from the configuration
+            continue
+        account.agent.restore_state(saved['agent'])
+        if account.chat_id is None:
+            account.chat_id = saved['chatId']
+        account.slot_index = SlotIndex.restore(saved['slotIndex'])
+        account.rules = RuleSet.restore(saved['rules'])
+        if 'scheduler' in saved:
+            account.scheduler.restore_state(saved['scheduler'])
+        if saved['scanning'] and account.chat_id is not None:
+            pool.start_scanning(account)
+
+async def post_init(application: Application) -> None:
+    ''' Restore the saved state and start the background work once the event loop is running. '''
+    global metrics_server
+    restore_app_state()
+    for account in pool:
+        account.agent.start_token_refresh()
+        pool.start_captcha_pool(
+            account,
+            size=int(os.getenv('BBDCTELEBOTCAPTCHAPOOLSIZE', '2')),
+            ttl=float(os.getenv('BBDCTELEBOTCAPTCHATTL', '60')),
+        )
+    pool.start(lambda account: scan_available_practical_slots(application, account))
+    if os.getenv('BBDCTELEBOTMETRICSPORT'):
+        # for Prometheus to scrape at /metrics
+        metrics_server = metrics.serve(int(os.getenv('BBDCTELEBOTMETRICSPORT')))
+    app_logger.info(f'Ready in {time.perf_counter() - started_at:.3f}s with {len(pool)} accounts.')
+
+async def post_shutdown(application: Application) -> None:
+    save_app_state()
+    await pool.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a telegram message to notify the developer."""
-    global my_chat_id
     # Log the error before we do anything else, so we can see it even if something breaks.
     app_logger.error("Exception while handling an update:", exc_info=context.error)
 
@@ -61,86 +139,313 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         f"<pre>{html.escape(tb_string)}</pre>"
     )
 
-    # Finally, send the message
-    await context.bot.send_message(
-        chat_id=my_chat_id, text=message, parse_mode=ParseMode.HTML
-    )
+    # Finally, send the message to the chat it came from, or to every linked chat
+    if isinstance(update, Update) and update.effective_chat is not None:
+        chat_ids = [update.effective_chat.id]
+    else:
+        chat_ids = [account.chat_id for account in pool if account.chat_id is not None]
+    for chat_id in chat_ids:
+        await context.bot.send_message(
+            chat_id=chat_id, text=message, parse_mode=ParseMode.HTML
+        )
+
+async def get_account(update: Update) -> Optional[Account]:
+    ''' Get the account linked to the chat, telling the chat if there is none. '''
+    account = pool.account_for_chat(update.effective_chat.id)
+    if account is None:
+        await update.message.reply_text('This chat is not linked to an account, send /start first.')
+    return account
 
-async def get_available_practical_slots(context: ContextTypes.DEFAULT_TYPE) -> None:
-    available_slots = agent.get_available_practical_slots()
-    context.job.data['available_slots'] = available_slots
-    if len(available_slots) == 0:
+async def scan_available_practical_slots(application: Application, account: Account) -> None:
+    agent = account.agent
+    expired_sessions = agent.expired_sessions
+    appeared = []
+    failed = True
+    try:
+        available_slots = []
+        async for slot in agent.iter_available_practical_slots(pool.months_into_future):
+            available_slots.append(slot)
+            # book newly listed matching slots straight away, while the remaining months are still loading,
+            # a slot that was already listed had its chance when it appeared
+            if account.slot_index.number_of(slot) is not None:
+                continue
+            rule = account.rules.match(slot)
+            if rule is not None:
+                application.create_task(auto_book_slot(application, account, slot, rule))
+        appeared, vanished = account.slot_index.update(available_slots)
+        failed = False
+    finally:
+        # the pool schedules the next scan however this one went
+        account.scheduler.record_scan(
+            len(appeared), failed, agent.expired_sessions > expired_sessions, bootstrap=not account.scanned,
+        )
+        account.scanned = account.scanned or not failed
+        save_app_state()
+    # only report what changed since the last scan
+    if len(appeared) == 0 and len(vanished) == 0:
         return
-    msg = f'Found {len(available_slots)} available practical slots:\n'
-    msg += '\n'.join([f'{i+1}. {slot}' for i, slot in enumerate(available_slots)])
-    await context.bot.send_message(chat_id=context.job.chat_id, text=msg)
+    msg = ''
+    if len(appeared) > 0:
+        msg += f'Found {len(appeared)} new practical slots:\n'
+        msg += '\n'.join([f'{number}. {slot}' for number, slot in appeared])
+    if len(vanished) > 0:
+        msg += f'\n\n{len(vanished)} slots are no longer available:\n'
+        msg += '\n'.join([f'{number}. {slot}' for number, slot in vanished])
+    await application.bot.send_message(chat_id=account.chat_id, text=msg.strip())
+
+async def auto_book_slot(application: Application, account: Account, slot, rule: BookingRule) -> None:
+    history = account.autobook_history
+    # book one slot at a time so the cap on held bookings is respected
+    async with account.autobook_lock:
+        if any(entry['slotId'] == slot.slotId and entry['success'] for entry in history):
+            return
+        rules = account.rules
+        if rules.max_bookings is not None:
+            # answered from the agent's cache while it is fresh
+            booked = await account.agent.count_booked_slots()
+            if booked is None:
+                # without the listing the cap can't be checked, don't risk going over it
+                app_logger.warning(f'Not auto-booking {slot} for {account.name}, could not count the bookings held.')
+                return
+            if not rules.has_capacity(booked):
+                app_logger.info(f'Not auto-booking {slot} for {account.name}, already holding {booked} bookings.')
+                return
+        success = await account.agent.book_practical_slot(slot)
+    history.append({'time': datetime.now(), 'slotId': slot.slotId, 'slot': str(slot), 'rule': str(rule), 'success': success})
+    if success:
+        account.slot_index.remove(slot.slotId)
+        await application.bot.send_message(chat_id=account.chat_id, text=f'Auto-booked {slot} (rule: {rule}).')
+    else:
+        await application.bot.send_message(chat_id=account.chat_id, text=f'Failed to auto-book {slot} (rule: {rule}).')
 
 async def handle_start_update_loop(update: Update, context: ContextTypes) -> None:
-    # save chat id
-    global my_chat_id
-    my_chat_id = update.message.chat_id
-    await update.message.reply_text('Starting update loop.')
-    # remove existing jobs
-    existing_jobs = context.job_queue.get_jobs_by_name('check_available_practical_slot')
-    for job in existing_jobs:
-        job.schedule_removal()
-    # start new job
-    context.job_queue.run_repeating(get_available_practical_slots, interval=2 * 60, first=1, name='check_available_practical_slot', chat_id=update.message.chat_id, data=context.user_data)
+    account = pool.account_for_chat(update.effective_chat.id)
+    if account is None and len(pool) == 1:
+        # link the only account to the first chat that starts it
+        account = next(iter(pool))
+        if account.chat_id is None:
+            account.chat_id = update.effective_chat.id
+        else:
+            account = None
+    if account is None:
+        await update.message.reply_text('This chat is not linked to an account.')
+        return
+    await update.message.reply_text(f'Starting update loop for {account.name}.')
+    pool.start_scanning(account)
+
+async def handle_show_schedule(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    if not account.scanning:
+        await update.message.reply_text('Update loop not started.')
+        return
+    await update.message.reply_text(account.scheduler.describe())
+
+async def handle_show_stats(update: Update, context: ContextTypes) -> None:
+    msg = 'Latency by stage, over the recent samples:\n' + metrics.summary()
+    account = pool.account_for_chat(update.effective_chat.id)
+    if account is not None and account.agent.captcha_pool is not None:
+        stats = account.agent.captcha_pool.stats()
+        msg += (f'\n\nCaptcha pool: {stats["size"]}/{stats["capacity"]} ready, '
+                f'{stats["hits"]} hits, {stats["misses"]} misses, {stats["expired"]} expired.')
+    await update.message.reply_text(msg)
+
+def format_booked_slots(booked_slots: list) -> str:
+    msg = f'Found {len(booked_slots)} booked slots:\n'
+    msg += '\n'.join([f'{i+1}. {lesson}' for i, lesson in enumerate(booked_slots)])
+    return msg
 
 async def handle_get_all_booked_slots(update: Update, context: ContextTypes) -> None:
-    global all_booked_slots
-    all_booked_slots = agent.get_all_booked_slots()
-    if len(all_booked_slots) == 0:
+    account = await get_account(update)
+    if account is None:
+        return
+    # `/booked refresh` skips the cache
+    max_age = 0 if context.args and context.args[0] == 'refresh' else None
+    # the numbers shown are the ones /delete takes
+    booked_slots = await account.agent.get_all_booked_slots(max_age)
+    if booked_slots is None:
+        await update.message.reply_text('Failed to get booked slots, try again later.')
+        return
+    account.booked_slots = booked_slots
+    if len(account.booked_slots) == 0:
         await update.message.reply_text('No booked slots.')
         return
-    msg = f'Found {len(all_booked_slots)} booked slots:\n'
-    msg += '\n'.join([f'{i+1}. {lesson}' for i, lesson in enumerate(all_booked_slots)])
-    await update.message.reply_text(msg)
+    await update.message.reply_text(format_booked_slots(account.booked_slots))
 
 async def handle_book_practical_slot(update: Update, context: ContextTypes) -> None:
-    if 'available_slots' not in context.user_data:
-        await update.message.reply_text('No available slots.')
+    account = await get_account(update)
+    if account is None:
         return
-    available_slots = context.user_data['available_slots']
-    if len(available_slots) == 0:
+    slot_index = account.slot_index
+    if len(slot_index) == 0:
         await update.message.reply_text('No available slots.')
         return
-    choice = int(context.args[0])
-    if choice < 1 or choice > len(available_slots):
+    # numbers are the ones shown when the slots were announced, several may be booked at once
+    slots = [slot_index.get(number) for number in sorted(set(int(arg) for arg in context.args))]
+    if len(slots) == 0 or None in slots:
         await update.message.reply_text('Invalid choice.')
         return
-    slot = available_slots[choice - 1]
-    await update.message.reply_text(f'Booking {slot}...')
-    success = agent.book_practical_slot(slot)
-    if not success:
-        await update.message.reply_text('Failed to book slot.')
+    await update.message.reply_text('Booking:\n' + '\n'.join([str(slot) for slot in slots]))
+    results = await account.agent.book_practical_slots(slots)
+    msg = ''
+    for slot in slots:
+        if results[slot.slotId]:
+            slot_index.remove(slot.slotId)
+            msg += f'Booked {slot}\n'
+        else:
+            msg += f'Failed to book {slot}\n'
+    await update.message.reply_text(msg.strip())
+
+async def handle_list_available_slots(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    slot_index = account.slot_index
+    if len(slot_index) == 0:
+        await update.message.reply_text('No available slots.')
         return
-    await update.message.reply_text('Successfully booked slot.')
+    msg = f'{len(slot_index)} available practical slots:\n'
+    msg += '\n'.join([f'{number}. {slot}' for number, slot in slot_index])
+    await update.message.reply_text(msg)
+
+async def handle_query_slots(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    try:
+        rule = parse_query(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f'Invalid query: {e}\nUsage: /slots sat,sun 0800-1200 <60 2024-02-01..2024-02-29')
+        return
+    # answered from the last scan
+    matches = account.slot_index.query(rule)
+    if len(matches) == 0:
+        await update.message.reply_text(f'No available slots matching {rule}.')
+        return
+    msg = f'{len(matches)} available slots matching {rule}:\n'
+    msg += '\n'.join([f'{number}. {slot}' for number, slot in matches])
+    await update.message.reply_text(msg)
 
 async def handle_delete_booking(update: Update, context: ContextTypes) -> None:
-    if len(all_booked_slots) == 0:
+    account = await get_account(update)
+    if account is None:
+        return
+    booked_slots = account.booked_slots
+    if len(booked_slots) == 0:
         await update.message.reply_text('No booked slots.')
         return
+    # numbers are the ones shown by the last /booked, several may be cancelled at once
+    choices = sorted(set(int(arg) for arg in context.args))
+    if len(choices) == 0 or choices[0] < 1 or choices[-1] > len(booked_slots):
+        await update.message.reply_text('Invalid choice.')
+        return
+    lessons = [booked_slots[choice - 1] for choice in choices]
+    await update.message.reply_text('Cancelling:\n' + '\n'.join([str(lesson) for lesson in lessons]))
+    results = await account.agent.cancel_practical_slots(lessons)
+    msg = ''
+    for lesson in lessons:
+        if results[lesson.bookingId]:
+            msg += f'Cancelled {lesson}\n'
+        else:
+            msg += f'Failed to cancel {lesson}\n'
+    # renumber, the cache already reflects the cancellations
+    booked_slots = await account.agent.get_all_booked_slots()
+    if booked_slots is None:
+        # the old numbers may point at cancelled bookings
+        account.booked_slots = []
+        msg += '\nSend /booked to see the remaining bookings.'
+    else:
+        account.booked_slots = booked_slots
+        if len(account.booked_slots) > 0:
+            msg += '\n' + format_booked_slots(account.booked_slots)
+    await update.message.reply_text(msg.strip())
+
+async def handle_list_rules(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    rules = account.rules
+    cap = 'no limit' if rules.max_bookings is None else str(rules.max_bookings)
+    if len(rules) == 0:
+        await update.message.reply_text(f'No auto-booking rules. Maximum bookings: {cap}.')
+        return
+    msg = f'{len(rules)} auto-booking rules, maximum bookings: {cap}.\n'
+    msg += '\n'.join([f'{i+1}. {rule}' for i, rule in enumerate(rules)])
+    await update.message.reply_text(msg)
+
+async def handle_add_rule(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    try:
+        rule = BookingRule.parse(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f'Invalid rule: {e}\nUsage: /addrule from=2024-02-01 to=2024-02-29 days=sat,sun time=0800-1200 name=... maxfee=60')
+        return
+    account.rules.add(rule)
+    await update.message.reply_text(f'Added rule {len(account.rules)}: {rule}')
+
+async def handle_delete_rule(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
     choice = int(context.args[0])
-    if choice < 1 or choice > len(all_booked_slots):
+    if choice < 1 or choice > len(account.rules):
         await update.message.reply_text('Invalid choice.')
         return
-    lesson = all_booked_slots[choice - 1]
-    await update.message.reply_text(f'Cancelling {lesson}...')
-    success = agent.cancel_practical_slot(lesson)
-    if not success:
-        await update.message.reply_text('Failed to cancel lesson.')
+    rule = account.rules.remove(choice - 1)
+    await update.message.reply_text(f'Removed rule: {rule}')
+
+async def handle_set_max_bookings(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
+        return
+    rules = account.rules
+    rules.max_bookings = int(context.args[0]) if context.args else None
+    await update.message.reply_text(f'Maximum bookings: {"no limit" if rules.max_bookings is None else rules.max_bookings}.')
+
+async def handle_autobook_history(update: Update, context: ContextTypes) -> None:
+    account = await get_account(update)
+    if account is None:
         return
-    await update.message.reply_text('Successfully cancelled lesson.')
+    history = account.autobook_history
+    if not history:
+        await update.message.reply_text('No auto-bookings yet.')
+        return
+    msg = f'Last {len(history)} auto-bookings:\n'
+    msg += '\n'.join([
+        f'{entry["time"]:%Y-%m-%d %H:%M:%S} {"booked" if entry["success"] else "failed"} {entry["slot"]} (rule: {entry["rule"]})'
+        for entry in history
+    ])
+    await update.message.reply_text(msg)
 
 def main() -> None:
     """Run the bot."""
+    add_accounts()
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(os.getenv('BBDCTELEBOTTOKEN')).build()
+    # updates are handled concurrently so a long scan or booking doesn't hold up other commands
+    application = (
+        Application.builder()
+        .token(os.getenv('BBDCTELEBOTTOKEN'))
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler('start', handle_start_update_loop))
     application.add_handler(CommandHandler('booked', handle_get_all_booked_slots))
     application.add_handler(CommandHandler('book', handle_book_practical_slot))
+    application.add_handler(CommandHandler('available', handle_list_available_slots))
+    application.add_handler(CommandHandler('slots', handle_query_slots))
+    application.add_handler(CommandHandler('schedule', handle_show_schedule))
+    application.add_handler(CommandHandler('stats', handle_show_stats))
+    application.add_handler(CommandHandler('rules', handle_list_rules))
+    application.add_handler(CommandHandler('addrule', handle_add_rule))
+    application.add_handler(CommandHandler('delrule', handle_delete_rule))
+    application.add_handler(CommandHandler('maxbookings', handle_set_max_bookings))
+    application.add_handler(CommandHandler('autobooked', handle_autobook_history))
     application.add_handler(CommandHandler('delete', handle_delete_booking))
     application.add_error_handler(error_handler)
 
@@ -0,0 +1,355 @@
+import asyncio
+import httpx
+from logging import Logger
+from typing import Optional
+from logs import Payload
+from metrics import metrics, endpoint_name
+from ocr_solver import OCRSolver
+from agent import BASE_URL, AgentBase, Slot, BookedSlot
+
+class AsyncAgent(AgentBase):
+    ''' An asyncio counterpart of `Agent`, with the same API as coroutines. '''
+
+    def __init__(self, logger: Logger, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 20, retries: int = 3,
+                 ocr_solver: OCRSolver = None, rate_limiters: list = (), booking_rate_limiters: list = None, base_url: str = BASE_URL):
+        # a solver passed in is shared with other agents and closed by its owner
+        self.__owns_ocr_solver = ocr_solver is None
+        # every request waits on each limiter, e.g. one for this account and one shared by all
+        self.__rate_limiters = list(rate_limiters)
+        # booking on demand (its captcha and the booking itself) may have an allowance of its own, so it doesn't queue behind scans
+        self.__booking_rate_limiters = self.__rate_limiters if booking_rate_limiters is None else list(booking_rate_limiters)
+        # the transport only retries failed connects, a POST that reached the server is never resent
+        self.__client = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=retries),
+        )
+        super().__init__(logger, base_url, ocr_solver)
+        self.authorization_token = ''
+        self.course_authorization_token = ''
+        self.__reauth_task = None
+        self.__refresh_task = None
+
+    @property
+    def authorization_token(self) -> str:
+        return self.__authorization_token
+
+    @authorization_token.setter
+    def authorization_token(self, token: str):
+        ''' Set the token and the client's auth header and cookie along with it. '''
+        self.__authorization_token = token
+        self.__client.headers['authorization'] = token
+        self.__client.cookies.set('bbdc-token', token.replace(' ', '%20'))
+
+    @property
+    def course_authorization_token(self) -> str:
+        return self.__course_authorization_token
+
+    @course_authorization_token.setter
+    def course_authorization_token(self, token: str):
+        self.__course_authorization_token = token
+        self.__client.headers['jsessionid'] = token
+
+    async def close(self):
+        ''' Stop the background work and close the connections. '''
+        self.stop_token_refresh()
+        self.stop_captcha_pool()
+        await self.__client.aclose()
+        if self.__owns_ocr_solver:
+            self._ocr_solver.close()
+
+    async def __wait_for_rate_limits(self, rate_limiters: list = None):
+        for limiter in self.__rate_limiters if rate_limiters is None else rate_limiters:
+            await limiter.acquire()
+
+    async def __post_unsigned(self, url: str, data: dict = None) -> dict:
+        ''' Post data to an endpoint of the login flow, without the auth header. '''
+        request = self.__client.build_request('POST', url, json=data)
+        request.headers['jsessionid'] = ''
+        del request.headers['authorization']
+        await self.__wait_for_rate_limits()
+        with metrics.time('request', endpoint=endpoint_name(url)) as timer:
+            response = await self.__client.send(request)
+            res = response.json()
+            timer.success = response.status_code == 200 and bool(res.get('success'))
+        return res
+
+    async def solve_captcha(self, captcha_type: str, tries: int = 10, rate_limiters: list = None):
+        ''' Attempt to pass the captcha, returning the captcha data and token. Booking captchas are fetched under `rate_limiters` if given. '''
+        self._info(f'Solving captcha..., type: {captcha_type}, tries: {tries}.')
+        url = self._captcha_url(captcha_type)
+        loop = asyncio.get_running_loop()
+        with metrics.time('captcha_solve', type=captcha_type) as solve_timer:
+            # issued captchas stay valid until used, the best low confidence one is submitted if none is confident
+            best = None
+            for i in range(tries):
+                self._info('Captcha attempt #' + str(i + 1))
+                # get captcha image
+                with metrics.time('captcha_fetch', type=captcha_type) as timer:
+                    if captcha_type == 'login':
+                        res = await self.__post_unsigned(url)
+                    else:
+                        res = await self.post_signed(url, {}, rate_limiters=rate_limiters)
+                    timer.success = res['success']
+                image = self._decode_captcha(res)
+                if image is None:
+                    continue
+                # solve captcha off the event loop
+                with metrics.time('captcha_ocr') as timer:
+                    answer, confidence = await loop.run_in_executor(None, self._ocr_solver.solve, image, 5)
+                    timer.success = self._is_plausible_answer(answer, confidence)
+                captcha_data = self._accept_captcha(res, image, captcha_type, answer, confidence)
+                if captcha_data is None:
+                    continue
+                if self._is_confident(captcha_data):
+                    return captcha_data
+                best = self._better_captcha(best, captcha_data)
+            solve_timer.success = best is not None
+            return self._fall_back_captcha(best)
+
+    def start_captcha_pool(self, size: int = 2, ttl: float = 60):
+        ''' Keep a pool of solved booking captchas ready in the background once there is a session, must be called from the event loop. '''
+        super().start_captcha_pool(size, ttl)
+
+    def _captcha_pool_solve(self):
+        loop = asyncio.get_running_loop()
+        # the pool's refill thread hands each solve back to the event loop and waits for it
+        return lambda: asyncio.run_coroutine_threadsafe(self.solve_captcha('booking'), loop).result()
+
+    def stop_captcha_pool(self):
+        ''' Stop the booking captcha pool, if running. '''
+        self._pending_captcha_pool = None
+        if self._captcha_pool is not None:
+            # joining would block the loop that the refill thread is waiting on
+            self._captcha_pool.stop(wait=False)
+            self._captcha_pool = None
+
+    async def take_booking_captcha(self):
+        ''' Take a solved booking captcha from the pool, solving one now if the pool is empty. '''
+        captcha_data = self._take_pooled_captcha()
+        if captcha_data is not None:
+            return captcha_data
+        return await self.solve_captcha('booking', rate_limiters=self.__booking_rate_limiters)
+
+    async def authenticate(self, username: str, password: str, tries: int = 10):
+        ''' Authenticate to the website. '''
+        self._info(f'Authenticating..., username: {username}, tries: {tries}.')
+        with metrics.time('auth') as timer:
+            for i in range(tries):
+                self._info('Authenticate attempt #' + str(i + 1))
+                # solve captcha
+                captcha_data = await self.solve_captcha('login')
+                if captcha_data is None:
+                    continue
+                # authenticate
+                res = await self.__post_unsigned(*self._login_request(captcha_data, username, password))
+                if not self._accept_login(captcha_data, res, username, password):
+                    continue
+                # get course authorization token
+                await self.get_course_authorization_token()
+                return res['data']['username']
+            timer.success = False
+            return None
+
+    async def get_course_authorization_token(self):
+        self._info('Getting course authorization token...')
+        url, payload = self._course_token_request()
+        # part of the login flow, an expired session here must not trigger another login
+        self._accept_course_token(await self.post_signed(url, payload, retries=0))
+
+    async def reauthenticate(self, logins: int = None):
+        ''' Reauthenticate using saved credentials, concurrent callers share a single login.
+
+        A caller passing the login count (`tokens.logins`) its request was sent with skips the login if one has finished since,
+        sharing its outcome, so a failing login is not retried by every caller in turn.
+        '''
+        self._check_saved_credentials()
+        if logins is not None and logins != self._tokens.logins:
+            return self._last_login
+        if self.__reauth_task is None or self.__reauth_task.done():
+            self._info('Reauthenticating...')
+            self.__reauth_task = asyncio.create_task(self.__reauthenticate_once())
+        else:
+            self._info('Waiting for the reauthentication in progress...')
+        # a cancelled caller must not cancel the login the others are waiting on
+        return await asyncio.shield(self.__reauth_task)
+
+    async def __reauthenticate_once(self):
+        with metrics.time('reauth') as timer:
+            username = await self.authenticate(self.saved_username, self.saved_password)
+            timer.success = username is not None
+        self._record_login(username)
+        return username
+
+    def start_token_refresh(self, retry_delay: float = 60):
+        ''' Refresh the tokens in the background ahead of their expiry, must be called from the event loop. '''
+        self.stop_token_refresh()
+        self.__refresh_task = asyncio.create_task(self.__refresh_tokens(retry_delay))
+
+    def stop_token_refresh(self):
+        if self.__refresh_task is not None:
+            self.__refresh_task.cancel()
+            self.__refresh_task = None
+
+    async def __refresh_tokens(self, retry_delay: float):
+        while True:
+            delay = self._seconds_until_refresh(retry_delay)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            self._info('Refreshing tokens ahead of expiry...')
+            try:
+                username = await self.reauthenticate()
+            except Exception:
+                self._logger.exception('Failed to refresh tokens.')
+                username = None
+            if username is None:
+                await asyncio.sleep(retry_delay)
+
+    async def post_signed(self, url: str, data: dict, retries: int = 2, rate_limiters: list = None) -> dict:
+        ''' Post data to a signed endpoint, reauthenticating at most `retries` times in all if the session has expired.
+
+        The request waits on `rate_limiters`, by default the agent's.
+        '''
+        reauths = 0
+        while True:
+            if reauths < retries and self._needs_login():
+                # the background refresh didn't get there in time
+                reauths += 1
+                if await self.reauthenticate() is None:
+                    # a failed login is not retried within the same request
+                    reauths = retries
+            self._info(f'POST {url}')
+            generation, logins = self._tokens.generation, self._tokens.logins
+            await self.__wait_for_rate_limits(rate_limiters)
+            # the auth headers and cookie are kept on the client
+            with metrics.time('request', endpoint=endpoint_name(url)) as timer:
+                response = await self.__client.post(url, json=data)
+                res = response.json()
+                timer.success = response.status_code == 200 and bool(res.get('success'))
+            self._debug('%s %s', response, Payload(res))
+            if response.status_code != 402:
+                self._tokens.confirm()
+                return res
+            if reauths >= retries:
+                return res
+            self._record_expired_session(generation)
+            reauths += 1
+            if await self.reauthenticate(logins) is None:
+                return res
+            # retry request
+
+    async def api_list_c3_practical_slot_released(self, month: str = None):
+        ''' List all C3 practical trainings. '''
+        return await self.post_signed(*self._released_slots_request(month))
+
+    async def __iter_released_months(self, maximum_months_into_future: int, max_concurrency: int):
+        ''' Query the months concurrently, yielding each month's available slots as soon as its listing returns. '''
+        with metrics.time('scan'):
+            semaphore = asyncio.Semaphore(max_concurrency)
+
+            async def list_month(month: str):
+                async with semaphore:
+                    return month, await self.api_list_c3_practical_slot_released(month)
+
+            tasks = [asyncio.create_task(list_month(month)) for month in self._months_into_future(maximum_months_into_future)]
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    month, res = await next_done
+                    yield month, self._parse_released_slots(month, res)
+            finally:
+                # the caller may stop early, don't leave the remaining queries running
+                for task in tasks:
+                    task.cancel()
+
+    async def iter_available_practical_slots(self, maximum_months_into_future: int = 3, max_concurrency: int = 3):
+        ''' Check for available practical slots, yielding them as soon as their month's listing returns. '''
+        async for month, slots in self.__iter_released_months(maximum_months_into_future, max_concurrency):
+            for slot in slots:
+                yield slot
+
+    async def get_available_practical_slots(self, maximum_months_into_future: int = 3, max_concurrency: int = 3):
+        ''' Check for available practical slots, querying the months concurrently. '''
+        return self._in_month_order({month: slots async for month, slots in self.__iter_released_months(maximum_months_into_future, max_concurrency)})
+
+    async def api_book_c3_practical_slot(self, captcha_data: dict, slot: Slot):
+        return await self.api_book_c3_practical_slots(captcha_data, [slot])
+
+    async def api_book_c3_practical_slots(self, captcha_data: dict, slots: list):
+        ''' Book several slots in one request, behind one captcha. '''
+        if captcha_data is None:
+            captcha_data = await self.take_booking_captcha()
+        url, data = self._book_request(captcha_data, slots)
+        return await self.post_signed(url, data, rate_limiters=self.__booking_rate_limiters)
+
+    async def book_practical_slot(self, slot: Slot):
+        ''' Book a practical slot. '''
+        results = await self.book_practical_slots([slot])
+        return results[slot.slotId]
+
+    async def book_practical_slots(self, slots: list) -> dict:
+        ''' Book several practical slots under one captcha, returning whether each slot id was booked. '''
+        slots = self._unique_slots(slots)
+        with metrics.time('book') as timer:
+            results = await self.__book_practical_slots(slots)
+            timer.success = all(results.values())
+        self._record_booking_results(results)
+        return results
+
+    async def __book_practical_slots(self, slots: list) -> dict:
+        self._info('Booking %d slots: %s.', len(slots), Payload(slots))
+        for attempt in range(self.booking_captcha_tries):
+            # take a pre-solved captcha if available
+            captcha_data = await self.take_booking_captcha()
+            if captcha_data is None:
+                self._error('Failed to book slots. Could not solve captcha.')
+                return {slot.slotId: False for slot in slots}
+            # book slots
+            res = await self.api_book_c3_practical_slots(captcha_data, slots)
+            if not self._retry_captcha(captcha_data, res, attempt):
+                break
+        results = self._parse_booking(captcha_data, slots, res)
+        if results is None:
+            results = {}
+            for half in self._halves(slots):
+                results.update(await self.__book_practical_slots(half))
+        return results
+
+    async def api_list_booked_c3_practical_slots(self, month: str = None):
+        return await self.post_signed(*self._booked_slots_request())
+
+    async def get_all_booked_slots(self, max_age: float = None) -> Optional[list]:
+        ''' Get all booked slots, from the cache if listed within `max_age` seconds (default: the cache's ttl), or None if they could not be listed. '''
+        slots = self._booked_slots.get(max_age)
+        if slots is not None:
+            return slots
+        self._info('Getting all booked slots...')
+        version = self._booked_slots.begin_listing()
+        return self._parse_booked_slots(await self.api_list_booked_c3_practical_slots(), version)
+
+    async def count_booked_slots(self) -> Optional[int]:
+        ''' Get the number of slots held, without a request while the cache is fresh, or None if they could not be listed. '''
+        count = self._booked_slots.count()
+        if count is None:
+            slots = await self.get_all_booked_slots()
+            count = None if slots is None else len(slots)
+        return count
+
+    async def api_cancel_c3_practical_slot(self, slot: BookedSlot):
+        return await self.post_signed(*self._cancel_request(slot))
+
+    async def cancel_practical_slot(self, slot: BookedSlot):
+        ''' Cancel a practical slot. '''
+        self._info('Cancelling slot: %s.', Payload(slot))
+        return self._parse_cancellation(slot, await self.api_cancel_c3_practical_slot(slot))
+
+    async def cancel_practical_slots(self, slots: list) -> dict:
+        ''' Cancel several practical slots concurrently, returning whether each booking id was cancelled. '''
+        slots = self._unique_bookings(slots)
+        results = await asyncio.gather(*[self.cancel_practical_slot(slot) for slot in slots], return_exceptions=True)
+        for slot, result in zip(slots, results):
+            if isinstance(result, Exception):
+                self._logger.error(f'Failed to cancel slot {slot.bookingId}.', exc_info=result)
+        # one failed cancel doesn't stop the others
+        return {slot.bookingId: result is True for slot, result in zip(slots, results)}
@@ -0,0 +1,498 @@
+''' Offline micro-benchmarks, run with `python benchmark.py <name> --help`. '''
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import random
+import statistics
+import threading
+import time
+from pprint import pformat
+from datetime import date
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from agent import Agent, Slot, create_session, parse_minutes, parse_slot_date
+from async_agent import AsyncAgent
+from booking_rules import RuleSet
+from captcha_corpus import CaptchaCorpus
+from logs import Payload, attach_queue
+from mock_server import MockBBDC, make_month_listing, make_synthetic_captcha, random_answer
+from slot_store import SlotStore, parse_query
+from ocr_solver import OCRSolver, BACKENDS, DEFAULT_VARIANTS, Variant
+
+# solver configurations compared by the corpus benchmark
+SOLVER_CONFIGS = {
+    'single': {'variants': (Variant(),)},
+    'voting': {'variants': DEFAULT_VARIANTS},
+}
+
+def percentile(values: list, pct: float):
+    ''' Nearest-rank percentile of the values. '''
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def report(label: str, latencies: list):
+    print(f'{label:<24} n={len(latencies):<5} mean={statistics.mean(latencies) * 1000:8.2f}ms '
+          f'p50={percentile(latencies, 50) * 1000:8.2f}ms p95={percentile(latencies, 95) * 1000:8.2f}ms')
+
+def bench_ocr_backends(args):
+    ''' Compare the per-solve latency of the OCR backends. '''
+    rng = random.Random(args.seed)
+    images = [make_synthetic_captcha(random_answer(rng), seed=i) for i in range(args.images)]
+    for name in args.backends:
+        # the first solve pays any one-off engine start up, keep it out of the steady state numbers
+        start = time.perf_counter()
+        solver = None
+        try:
+            # a single variant read in this process, the latency of the engine rather than of the voting pool
+            solver = OCRSolver(name, variants=(Variant(),), processes=1)
+            solver.solve(images[0])
+            print(f'{name:<24} first solve {(time.perf_counter() - start) * 1000:.2f}ms')
+            latencies = []
+            for image in images:
+                start = time.perf_counter()
+                solver.solve(image)
+                latencies.append(time.perf_counter() - start)
+            report(name, latencies)
+        except (RuntimeError, OSError) as e:
+            print(f'{name:<24} skipped: {e}')
+        finally:
+            if solver is not None:
+                solver.close()
+
+# the solver owned by each benchmark worker process
+_worker_solver = None
+
+def _init_corpus_worker(backend: str, config: str):
+    global _worker_solver
+    _worker_solver = OCRSolver(backend, processes=1, **SOLVER_CONFIGS[config])
+
+def _solve_timed(image: bytes):
+    start = time.perf_counter()
+    answer, confidence = _worker_solver.solve(image, length=5)
+    return answer, time.perf_counter() - start
+
+def _solve_confidence(image: bytes):
+    return _worker_solver.solve(image, length=5)
+
+def describe_corpus(entries: list):
+    ''' Print what the corpus holds by recording solver, and how that skews the accuracy measured on it. '''
+    by_solver = defaultdict(list)
+    for entry in entries:
+        by_solver[entry.solver or 'unknown solver'].append(entry)
+    for solver, recorded in by_solver.items():
+        accepted = sum(entry.success is True for entry in recorded)
+        refused = sum(entry.success is False for entry in recorded)
+        manual = sum(entry.manualLabel is not None for entry in recorded)
+        print(f'Recorded by {solver}: {len(recorded)} captchas, {accepted} accepted, {refused} refused, '
+              f'{len(recorded) - accepted - refused} never submitted, {manual} labelled by hand.')
+    unlabelled = sum(entry.label is None for entry in entries)
+    if unlabelled:
+        # only the answers the server accepted are known, the captchas the recording solver got wrong are left out
+        print(f'{unlabelled} captchas have no label and are left out, so accuracy is biased toward the recording solver. '
+              f'Label them with `benchmark.py label`.')
+
+def bench_corpus(args):
+    ''' Replay a recorded captcha corpus offline, reporting accuracy, latency and throughput. '''
+    corpus = CaptchaCorpus(args.corpus)
+    entries = corpus.entries()
+    describe_corpus(entries)
+    entries = [entry for entry in entries if entry.label is not None]
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print(f'No labelled captchas in {args.corpus}.')
+        return
+    images = [corpus.read_image(entry) for entry in entries]
+    print(f'Replaying {len(entries)} labelled captchas.')
+    for config in args.configs:
+        for mode in args.modes:
+            start = time.perf_counter()
+            if mode == 'serial':
+                _init_corpus_worker(args.backend, config)
+                results = [_solve_timed(image) for image in images]
+            else:
+                # each worker solves whole captchas with its variants run in turn
+                with ProcessPoolExecutor(args.processes, initializer=_init_corpus_worker, initargs=(args.backend, config)) as pool:
+                    results = list(pool.map(_solve_timed, images))
+            elapsed = time.perf_counter() - start
+            correct = sum(answer == entry.label for (answer, _), entry in zip(results, entries))
+            label = f'{config}/{mode}'
+            report(label, [latency for _, latency in results])
+            print(f'{"":<24} accuracy={correct / len(entries):.1%} throughput={len(entries) / elapsed:.2f}/s')
+
+def calibrate_confidence(args):
+    ''' Suggest the captcha confidence cutoff needing the fewest requests per accepted answer on a labelled corpus. '''
+    corpus = CaptchaCorpus(args.corpus)
+    entries = corpus.entries()
+    describe_corpus(entries)
+    entries = [entry for entry in entries if entry.label is not None]
+    if not entries:
+        print(f'No labelled captchas in {args.corpus}.')
+        return
+    images = [corpus.read_image(entry) for entry in entries]
+    # the confidences recorded with the corpus may come from another solver, read them again
+    with ProcessPoolExecutor(args.processes, initializer=_init_corpus_worker, initargs=(args.backend, 'voting')) as pool:
+        readings = list(pool.map(_solve_confidence, images))
+    print(f'{"cutoff":<8} {"submitted":>10} {"accuracy":>10} {"requests per success":>22}')
+    best = None
+    for step in range(21):
+        cutoff = step / 20
+        submitted = [answer == entry.label for (answer, confidence), entry in zip(readings, entries) if confidence >= cutoff]
+        correct = sum(submitted)
+        # every try fetches a captcha, and the submitted ones cost a request more
+        requests_per_success = (len(entries) + len(submitted)) / correct if correct else float('inf')
+        accuracy = correct / len(submitted) if submitted else 0.0
+        print(f'{cutoff:<8.2f} {len(submitted) / len(entries):>10.1%} {accuracy:>10.1%} {requests_per_success:>22.2f}')
+        if best is None or requests_per_success < best[1]:
+            best = (cutoff, requests_per_success)
+    print(f'Suggested cutoff: {best[0]:.2f} (currently {Agent.min_captcha_confidence}), set it with BBDCTELEBOTCAPTCHACONFIDENCE.')
+
+def label_corpus(args):
+    ''' Label by hand the captchas of a corpus the server refused or that were never submitted. '''
+    corpus = CaptchaCorpus(args.corpus)
+    pending = corpus.unlabelled()
+    if args.limit:
+        pending = pending[:args.limit]
+    path = os.path.join(tempfile.gettempdir(), 'captcha.png')
+    print(f'{len(pending)} captchas to label, each is written to {path}. Enter the answer, nothing to skip or q to stop.')
+    for i, entry in enumerate(pending):
+        with open(path, 'wb') as f:
+            f.write(corpus.read_image(entry))
+        verdict = 'never submitted' if entry.success is None else f'refused: {entry.message}'
+        text = input(f'[{i + 1}/{len(pending)}] read as {entry.answer!r}, {verdict} > ').strip()
+        if text == 'q':
+            break
+        if text:
+            corpus.record_label(entry.recordId, text)
+
+class EchoHandler(BaseHTTPRequestHandler):
+    ''' Answers every POST with a small JSON body over a keep-alive connection. '''
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, don't let them wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        body = json.dumps({'success': True, 'message': '', 'data': {}}).encode()
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def bench_http(args):
+    ''' Compare per-request latency of one-off requests.post calls and the Agent's pooled session. '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/api'
+    session = create_session()
+    clients = {
+        'requests.post': requests.post,
+        'pooled session': session.post,
+    }
+    for name, post in clients.items():
+        latencies = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            post(url, json={'courseType': '3A'}, timeout=(5, 20)).json()
+            latencies.append(time.perf_counter() - start)
+        report(name, latencies)
+    server.shutdown()
+
+# queries timed by the slots benchmark
+SLOT_QUERIES = ['sat,sun 0800-1200 <60', '0700-0930', '<50', '2024-03-01..2024-03-07 1300-']
+
+def bench_slots(args):
+    ''' Compare parsing and querying large slot listings with the indexed store and a scan that re-parses the strings. '''
+    rng = random.Random(args.seed)
+    months = [date(2024, month, 1) for month in range(1, args.months + 1)]
+    bodies = [json.dumps(make_month_listing(month, args.slots_per_session, rng)) for month in months]
+    parse_latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        slots = [
+            Slot.from_dict(slot)
+            for body in bodies
+            for listing in json.loads(body)['data']['releasedSlotListGroupByDay'].values()
+            for slot in listing
+        ]
+        parse_latencies.append(time.perf_counter() - start)
+    print(f'{len(slots)} slots over {args.months} months')
+    report('parse listing', parse_latencies)
+    build_latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        store = SlotStore(slots)
+        build_latencies.append(time.perf_counter() - start)
+    report('build store', build_latencies)
+    for query in SLOT_QUERIES:
+        rule = parse_query(query.split())
+        matcher = rule.compile()
+        rescan_latencies, store_latencies = [], []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            expected = [
+                slot for slot in slots
+                if matcher(parse_slot_date(slot.slotRefDate), parse_minutes(slot.startTime),
+                           parse_minutes(slot.endTime), slot.slotRefName, slot.totalFee)
+            ]
+            rescan_latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            found = store.query(rule)
+            store_latencies.append(time.perf_counter() - start)
+        assert {slot.slotId for slot in found} == {slot.slotId for slot in expected}
+        print(f'{query!r}: {len(found)} matches')
+        report('  re-parsing scan', rescan_latencies)
+        report('  indexed store', store_latencies)
+    rules = RuleSet([parse_query(query.split()) for query in SLOT_QUERIES])
+    match_latencies = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for slot in slots:
+            rules.match(slot)
+        match_latencies.append(time.perf_counter() - start)
+    report('rule match, all slots', match_latencies)
+
+def log_scan_eagerly(log: logging.Logger, responses: list, listings: list):
+    ''' The logging of a scan as the agents did it before, rendering every payload up front. '''
+    log.info('Checking for available practical slots, maximum months into future: 3.')
+    for res, slots in zip(responses, listings):
+        log.info('POST https://booking.bbdc.sg/bbdc-back-service/api/booking/c3practical/listC3PracticalSlotReleased')
+        log.debug(pformat('<Response [200]>', indent=4))
+        log.debug(pformat(res, indent=4))
+        log.info(f'Found {len(slots)} slots.')
+        log.debug(pformat(slots, indent=4))
+
+def log_scan_sampled(log: logging.Logger, responses: list, listings: list):
+    ''' The payloads sampled as the agents do it now but rendered up front, to tell the gain of sampling from that of deferring. '''
+    log.info('Checking for available practical slots, maximum months into future: 3.')
+    for res, slots in zip(responses, listings):
+        log.info('POST https://booking.bbdc.sg/bbdc-back-service/api/booking/c3practical/listC3PracticalSlotReleased')
+        log.debug('%s %s', '<Response [200]>', str(Payload(res)))
+        log.info(f'Found {len(slots)} slots.')
+        log.debug('%s', str(Payload(slots)))
+
+def log_scan_lazily(log: logging.Logger, responses: list, listings: list):
+    ''' The logging of a scan as the agents do it now. '''
+    log.info('Checking for available practical slots, maximum months into future: 3.')
+    for res, slots in zip(responses, listings):
+        log.info('POST https://booking.bbdc.sg/bbdc-back-service/api/booking/c3practical/listC3PracticalSlotReleased')
+        log.debug('%s %s', '<Response [200]>', Payload(res))
+        log.info(f'Found {len(slots)} slots.')
+        log.debug('%s', Payload(slots))
+
+def bench_logging(args):
+    ''' Measure the time a scan spends logging on the calling thread, with the old and the queued loggers. '''
+    rng = random.Random(args.seed)
+    responses = [make_month_listing(date(2024, month, 1), args.slots_per_session, rng) for month in (1, 2, 3)]
+    listings = [
+        [Slot.from_dict(slot) for listing in res['data']['releasedSlotListGroupByDay'].values() for slot in listing]
+        for res in responses
+    ]
+    directory = tempfile.mkdtemp()
+    configs = [
+        ('file, debug, eager', False, logging.DEBUG, log_scan_eagerly),
+        ('file, debug, sampled', False, logging.DEBUG, log_scan_sampled),
+        ('queue, debug, lazy', True, logging.DEBUG, log_scan_lazily),
+        ('queue, info, lazy', True, logging.INFO, log_scan_lazily),
+    ]
+    for i, (label, queued, level, log_scan) in enumerate(configs):
+        log = logging.getLogger(f'bench{i}')
+        log.propagate = False
+        log.setLevel(level)
+        handler = logging.FileHandler(os.path.join(directory, f'{i}.log'))
+        handler.setFormatter(logging.Formatter('[%(name)s] %(asctime)s - %(levelname)s - %(message)s'))
+        if queued:
+            listener = attach_queue(log, handler)
+        else:
+            log.addHandler(handler)
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.scans):
+            scan_start = time.perf_counter()
+            log_scan(log, responses, listings)
+            latencies.append(time.perf_counter() - scan_start)
+        if queued:
+            # wait for the listener to write everything out
+            listener.stop()
+        elapsed = time.perf_counter() - start
+        report(label, latencies)
+        print(f'{"":<24} total with writes={elapsed / args.scans * 1000:.2f}ms/scan')
+
+class OracleSolver:
+    ''' Reads captchas by asking the stand-in server for their answers, so OCR cost and accuracy stay out of the measurements. '''
+
+    def __init__(self, mock: MockBBDC):
+        self.mock = mock
+
+    def solve(self, image: bytes, length: int = None):
+        return self.mock.answer_for(image), 1.0
+
+    def describe(self) -> str:
+        return 'oracle'
+
+    def close(self):
+        pass
+
+def e2e_agents(args, mock: MockBBDC):
+    ''' The agent configurations compared by the e2e benchmark, as (label, kind, agent, max_concurrency). '''
+    logger = logging.getLogger('e2e')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    ocr_solver = OracleSolver(mock) if args.ocr == 'oracle' else None
+    configs = []
+    for label, kind, max_concurrency in [('sync serial', 'sync', 1), ('sync threads', 'sync', 3), ('async', 'async', 3)]:
+        if kind == 'sync':
+            agent = Agent(logger, base_url=mock.base_url, ocr_solver=ocr_solver)
+        else:
+            agent = AsyncAgent(logger, base_url=mock.base_url, ocr_solver=ocr_solver)
+        agent.set_credentials(mock.username, mock.password)
+        configs.append((label, kind, agent, max_concurrency))
+    return configs
+
+def bench_e2e_sync(args, mock: MockBBDC, agent: Agent, max_concurrency: int) -> dict:
+    agent.get_available_practical_slots(max_concurrency=max_concurrency)
+    scans = []
+    for _ in range(args.scans):
+        start = time.perf_counter()
+        agent.get_available_practical_slots(max_concurrency=max_concurrency)
+        scans.append(time.perf_counter() - start)
+    bookings = []
+    for _ in range(args.bookings):
+        mock.release_slots(1)
+        start = time.perf_counter()
+        slots = agent.get_available_practical_slots(max_concurrency=max_concurrency)
+        agent.book_practical_slot(slots[0])
+        bookings.append(time.perf_counter() - start)
+    storms = []
+    logins = []
+    with ThreadPoolExecutor(args.storm) as executor:
+        for _ in range(args.storms):
+            mock.expire_sessions()
+            logins_before = mock.logins
+            start = time.perf_counter()
+            list(executor.map(lambda _: agent.api_list_booked_c3_practical_slots(), range(args.storm)))
+            storms.append(time.perf_counter() - start)
+            logins.append(mock.logins - logins_before)
+    return {'scans': scans, 'bookings': bookings, 'storms': storms, 'logins': logins}
+
+async def bench_e2e_async(args, mock: MockBBDC, agent: AsyncAgent, max_concurrency: int) -> dict:
+    await agent.get_available_practical_slots(max_concurrency=max_concurrency)
+    scans = []
+    for _ in range(args.scans):
+        start = time.perf_counter()
+        await agent.get_available_practical_slots(max_concurrency=max_concurrency)
+        scans.append(time.perf_counter() - start)
+    bookings = []
+    for _ in range(args.bookings):
+        mock.release_slots(1)
+        start = time.perf_counter()
+        slots = await agent.get_available_practical_slots(max_concurrency=max_concurrency)
+        await agent.book_practical_slot(slots[0])
+        bookings.append(time.perf_counter() - start)
+    storms = []
+    logins = []
+    for _ in range(args.storms):
+        mock.expire_sessions()
+        logins_before = mock.logins
+        start = time.perf_counter()
+        await asyncio.gather(*[agent.api_list_booked_c3_practical_slots() for _ in range(args.storm)])
+        storms.append(time.perf_counter() - start)
+        logins.append(mock.logins - logins_before)
+    await agent.close()
+    return {'scans': scans, 'bookings': bookings, 'storms': storms, 'logins': logins}
+
+def bench_e2e(args):
+    ''' Measure scan throughput, time-to-book and reauthentication storms against the local stand-in server. '''
+    mock = MockBBDC(latency=args.latency, jitter=args.jitter, slots_per_session=args.slots_per_session)
+    # leave only a few slots listed, as on a typical day
+    mock.take_slots(1.0)
+    mock.start()
+    for label, kind, agent, max_concurrency in e2e_agents(args, mock):
+        if kind == 'sync':
+            results = bench_e2e_sync(args, mock, agent, max_concurrency)
+        else:
+            results = asyncio.run(bench_e2e_async(args, mock, agent, max_concurrency))
+        print(f'{label}:')
+        report('  scan', results['scans'])
+        print(f'{"":<24} throughput={len(results["scans"]) / sum(results["scans"]):.2f} scans/s')
+        report('  scan and book', results['bookings'])
+        report(f'  storm of {args.storm}', results['storms'])
+        print(f'{"":<24} logins per storm={statistics.mean(results["logins"]):.1f}')
+    mock.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ocr_parser = subparsers.add_parser('ocr-backends', help=bench_ocr_backends.__doc__)
+    ocr_parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    ocr_parser.add_argument('--images', type=int, default=50)
+    ocr_parser.add_argument('--seed', type=int, default=0)
+    ocr_parser.set_defaults(func=bench_ocr_backends)
+
+    corpus_parser = subparsers.add_parser('corpus', help=bench_corpus.__doc__)
+    corpus_parser.add_argument('corpus', help='directory recorded with Agent.record_captchas')
+    corpus_parser.add_argument('--backend', default='auto', choices=['auto'] + list(BACKENDS))
+    corpus_parser.add_argument('--configs', nargs='+', default=list(SOLVER_CONFIGS), choices=list(SOLVER_CONFIGS))
+    corpus_parser.add_argument('--modes', nargs='+', default=['serial', 'multicore'], choices=['serial', 'multicore'])
+    corpus_parser.add_argument('--processes', type=int, default=os.cpu_count())
+    corpus_parser.add_argument('--limit', type=int, default=0)
+    corpus_parser.set_defaults(func=bench_corpus)
+
+    calibrate_parser = subparsers.add_parser('calibrate', help=calibrate_confidence.__doc__)
+    calibrate_parser.add_argument('corpus', help='directory recorded with Agent.record_captchas')
+    calibrate_parser.add_argument('--backend', default='auto', choices=['auto'] + list(BACKENDS))
+    calibrate_parser.add_argument('--processes', type=int, default=os.cpu_count())
+    calibrate_parser.set_defaults(func=calibrate_confidence)
+
+    label_parser = subparsers.add_parser('label', help=label_corpus.__doc__)
+    label_parser.add_argument('corpus', help='directory recorded with Agent.record_captchas')
+    label_parser.add_argument('--limit', type=int, default=0)
+    label_parser.set_defaults(func=label_corpus)
+
+    http_parser = subparsers.add_parser('http', help=bench_http.__doc__)
+    http_parser.add_argument('--requests', type=int, default=200)
+    http_parser.set_defaults(func=bench_http)
+
+    slots_parser = subparsers.add_parser('slots', help=bench_slots.__doc__)
+    slots_parser.add_argument('--months', type=int, default=3)
+    slots_parser.add_argument('--slots-per-session', type=int, default=20)
+    slots_parser.add_argument('--repeat', type=int, default=20)
+    slots_parser.add_argument('--seed', type=int, default=0)
+    slots_parser.set_defaults(func=bench_slots)
+
+    logging_parser = subparsers.add_parser('logging', help=bench_logging.__doc__)
+    logging_parser.add_argument('--scans', type=int, default=20)
+    logging_parser.add_argument('--slots-per-session', type=int, default=2)
+    logging_parser.add_argument('--seed', type=int, default=0)
+    logging_parser.set_defaults(func=bench_logging)
+
+    e2e_parser = subparsers.add_parser('e2e', help=bench_e2e.__doc__)
+    e2e_parser.add_argument('--ocr', default='oracle', choices=['oracle', 'tesseract'], help='how the agents read captchas')
+    e2e_parser.add_argument('--latency', type=float, default=0.05, help='server latency in seconds')
+    e2e_parser.add_argument('--jitter', type=float, default=0.02)
+    e2e_parser.add_argument('--slots-per-session', type=int, default=1)
+    e2e_parser.add_argument('--scans', type=int, default=20)
+    e2e_parser.add_argument('--bookings', type=int, default=10)
+    e2e_parser.add_argument('--storms', type=int, default=5)
+    e2e_parser.add_argument('--storm', type=int, default=10, help='concurrent requests hitting an expired session')
+    e2e_parser.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import threading
+import time
+from typing import Optional
+
+class BookedSlotCache:
+    ''' The learner's booked slots as last listed, kept up to date by the agent's own bookings and cancellations.
+
+    A booking only bumps the count, since the booking id it was given is not known until the next listing.
+    '''
+
+    def __init__(self, ttl: float = 60):
+        self.ttl = ttl
+        self.__slots = None
+        self.__listed_at = 0.0
+        # slots booked since the listing
+        self.__pending_bookings = 0
+        # bumped by every change, a listing fetched across a change may already be out of date
+        self.__version = 0
+        self.__lock = threading.Lock()
+
+    def __is_fresh(self, max_age: float = None) -> bool:
+        max_age = self.ttl if max_age is None else max_age
+        return self.__slots is not None and time.monotonic() - self.__listed_at < max_age
+
+    def get(self, max_age: float = None) -> Optional[list]:
+        ''' Get the booked slots if listed within `max_age` seconds (default: the ttl) and complete, otherwise None. '''
+        with self.__lock:
+            if not self.__is_fresh(max_age) or self.__pending_bookings > 0:
+                return None
+            return list(self.__slots)
+
+    def count(self) -> Optional[int]:
+        ''' Get the number of slots held if the listing is fresh, otherwise None. '''
+        with self.__lock:
+            if not self.__is_fresh():
+                return None
+            return len(self.__slots) + self.__pending_bookings
+
+    def begin_listing(self) -> int:
+        ''' Call before fetching a listing, passing the result to `store`. '''
+        return self.__version
+
+    def store(self, slots: list, version: int):
+        ''' Cache a listing, unless something changed since it was requested. '''
+        with self.__lock:
+            if version != self.__version:
+                return
+            self.__slots = list(slots)
+            self.__listed_at = time.monotonic()
+            self.__pending_bookings = 0
+
+    def record_bookings(self, count: int):
+        with self.__lock:
+            self.__version += 1
+            self.__pending_bookings += count
+
+    def record_cancellation(self, booking_id: int):
+        with self.__lock:
+            self.__version += 1
+            if self.__slots is not None:
+                self.__slots = [slot for slot in self.__slots if slot.bookingId != booking_id]
+
+    def invalidate(self):
+        with self.__lock:
+            self.__version += 1
+            self.__slots = None
+            self.__pending_bookings = 0
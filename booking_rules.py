@@ -0,0 +1,151 @@
+from dataclasses import dataclass
+from datetime import date
+from typing import Optional
+
+from agent import Slot, parse_minutes
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def format_minutes(minutes: int) -> str:
+    return f'{minutes // 60:02d}{minutes % 60:02d}'
+
+@dataclass
+class BookingRule:
+    ''' Slots to book automatically, every field that is set must match. '''
+    from_date: Optional[date] = None
+    to_date: Optional[date] = None
+    weekdays: Optional[frozenset] = None
+    # minutes since midnight, the slot must lie within the window
+    start_minutes: Optional[int] = None
+    end_minutes: Optional[int] = None
+    names: Optional[frozenset] = None
+    max_fee: Optional[float] = None
+
+    @classmethod
+    def parse(cls, args: list):
+        ''' Parse a rule from `key=value` arguments: from, to, days, time, name and maxfee.
+
+        e.g. `from=2024-02-01 to=2024-02-29 days=sat,sun time=0800-1200 maxfee=60`
+        '''
+        rule = cls()
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if not sep or not value:
+                raise ValueError(f'Expected key=value, got: {arg}')
+            if key == 'from':
+                rule.from_date = date.fromisoformat(value)
+            elif key == 'to':
+                rule.to_date = date.fromisoformat(value)
+            elif key == 'days':
+                days = value.lower().split(',')
+                unknown = [day for day in days if day not in WEEKDAYS]
+                if unknown:
+                    raise ValueError(f'Unknown days: {", ".join(unknown)}')
+                rule.weekdays = frozenset(WEEKDAYS.index(day) for day in days)
+            elif key == 'time':
+                start, sep, end = value.partition('-')
+                rule.start_minutes = parse_minutes(start)
+                rule.end_minutes = parse_minutes(end) if end else None
+            elif key == 'name':
+                rule.names = frozenset(value.split(','))
+            elif key == 'maxfee':
+                rule.max_fee = float(value)
+            else:
+                raise ValueError(f'Unknown rule key: {key}')
+        return rule
+
+    def compile(self):
+        ''' Build a predicate on the parsed slot fields that only checks the fields that are set. '''
+        checks = []
+        if self.from_date is not None:
+            checks.append(lambda day, start, end, name, fee: day >= self.from_date)
+        if self.to_date is not None:
+            checks.append(lambda day, start, end, name, fee: day <= self.to_date)
+        if self.weekdays is not None:
+            checks.append(lambda day, start, end, name, fee: day.weekday() in self.weekdays)
+        if self.start_minutes is not None:
+            checks.append(lambda day, start, end, name, fee: start >= self.start_minutes)
+        if self.end_minutes is not None:
+            checks.append(lambda day, start, end, name, fee: end <= self.end_minutes)
+        if self.names is not None:
+            checks.append(lambda day, start, end, name, fee: name in self.names)
+        if self.max_fee is not None:
+            checks.append(lambda day, start, end, name, fee: fee <= self.max_fee)
+        return lambda *fields: all(check(*fields) for check in checks)
+
+    def to_args(self) -> list:
+        ''' The `key=value` arguments that `parse` turns back into this rule. '''
+        parts = []
+        if self.from_date is not None:
+            parts.append(f'from={self.from_date}')
+        if self.to_date is not None:
+            parts.append(f'to={self.to_date}')
+        if self.weekdays is not None:
+            parts.append('days=' + ','.join(WEEKDAYS[day] for day in sorted(self.weekdays)))
+        if self.start_minutes is not None or self.end_minutes is not None:
+            start = format_minutes(self.start_minutes) if self.start_minutes is not None else '0000'
+            end = format_minutes(self.end_minutes) if self.end_minutes is not None else ''
+            parts.append(f'time={start}-{end}')
+        if self.names is not None:
+            parts.append('name=' + ','.join(sorted(self.names)))
+        if self.max_fee is not None:
+            parts.append(f'maxfee={self.max_fee:g}')
+        return parts
+
+    def __str__(self):
+        return ' '.join(self.to_args()) or 'any slot'
+
+class RuleSet:
+    ''' The auto-booking rules with a cap on the number of slots held. '''
+
+    def __init__(self, rules: list = None, max_bookings: int = None):
+        self.__rules = list(rules or [])
+        self.max_bookings = max_bookings
+        self.__compile()
+
+    def __compile(self):
+        self.__matchers = [(rule, rule.compile()) for rule in self.__rules]
+
+    def __len__(self):
+        return len(self.__rules)
+
+    def __iter__(self):
+        return iter(self.__rules)
+
+    def add(self, rule: BookingRule):
+        self.__rules.append(rule)
+        self.__compile()
+
+    def remove(self, index: int) -> BookingRule:
+        rule = self.__rules.pop(index)
+        self.__compile()
+        return rule
+
+    def export(self) -> dict:
+        ''' Get the rules as plain data, for saving. '''
+        return {'rules': [rule.to_args() for rule in self.__rules], 'maxBookings': self.max_bookings}
+
+    @classmethod
+    def restore(cls, data: dict):
+        ''' Rebuild the rules saved by `export`. '''
+        return cls([BookingRule.parse(args) for args in data['rules']], data['maxBookings'])
+
+    def match(self, slot: Slot) -> Optional[BookingRule]:
+        ''' Get the first rule the slot satisfies, or None. '''
+        if not self.__matchers:
+            return None
+        fields = (
+            slot.day,
+            slot.start_minutes,
+            slot.end_minutes,
+            slot.slotRefName,
+            slot.totalFee,
+        )
+        for rule, matcher in self.__matchers:
+            if matcher(*fields):
+                return rule
+        return None
+
+    def has_capacity(self, booked: int) -> bool:
+        ''' Whether another slot may be booked while holding this many. '''
+        return self.max_bookings is None or booked < self.max_bookings
@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass
+class CorpusEntry:
+    recordId: int
+    captchaType: str
+    answer: str
+    confidence: float
+    recordedAt: float
+    offset: int
+    length: int
+    # the solver configuration that read the captcha
+    solver: Optional[str] = None
+    success: Optional[bool] = None
+    message: Optional[str] = None
+    # the answer typed in by hand, for captchas the solver got wrong or skipped
+    manualLabel: Optional[str] = None
+
+    @property
+    def label(self) -> Optional[str]:
+        ''' The known correct answer, from a manual label or else the answer the server accepted. '''
+        if self.manualLabel is not None:
+            return self.manualLabel
+        return self.answer if self.success else None
+
+class CaptchaCorpus:
+    ''' An append-only corpus of captcha images, solver answers and server verdicts.
+
+    Images are packed back to back into `images.bin`, and `index.jsonl` holds one line per
+    recorded captcha followed later by one line per verdict or manual label, all keyed by the image offset.
+
+    The server only confirms answers it accepted, so without manual labels the corpus only holds
+    captchas the recording `solver` read correctly.
+    '''
+
+    def __init__(self, directory: str, solver: str = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.solver = solver
+        self.__images_path = os.path.join(directory, 'images.bin')
+        self.__index_path = os.path.join(directory, 'index.jsonl')
+        self.__lock = threading.Lock()
+
+    def __append_index(self, line: dict):
+        with open(self.__index_path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+
+    def record(self, image: bytes, captcha_type: str, answer: str, confidence: float) -> int:
+        ''' Store a captcha image with the solver's answer, returning its record id. '''
+        with self.__lock:
+            with open(self.__images_path, 'ab') as f:
+                offset = f.tell()
+                f.write(image)
+            self.__append_index({
+                'recordId': offset,
+                'captchaType': captcha_type,
+                'answer': answer,
+                'confidence': confidence,
+                'recordedAt': time.time(),
+                'offset': offset,
+                'length': len(image),
+                'solver': self.solver,
+            })
+        return offset
+
+    def record_verdict(self, record_id: int, success: bool, message: str):
+        ''' Store the server's verdict on a recorded answer. '''
+        with self.__lock:
+            self.__append_index({'recordId': record_id, 'success': success, 'message': message})
+
+    def record_label(self, record_id: int, label: str):
+        ''' Store the correct answer of a recorded captcha, as read by a person. '''
+        with self.__lock:
+            self.__append_index({'recordId': record_id, 'label': label})
+
+    def entries(self) -> list:
+        ''' Load all recorded captchas with their verdicts. '''
+        if not os.path.exists(self.__index_path):
+            return []
+        entries = {}
+        with open(self.__index_path) as f:
+            for line in f:
+                line = json.loads(line)
+                if 'offset' in line:
+                    entries[line['recordId']] = CorpusEntry(**line)
+                elif 'label' in line:
+                    if line['recordId'] in entries:
+                        entries[line['recordId']].manualLabel = line['label']
+                elif line['recordId'] in entries:
+                    entries[line['recordId']].success = line['success']
+                    entries[line['recordId']].message = line['message']
+        return list(entries.values())
+
+    def unlabelled(self) -> list:
+        ''' Get the captchas with no known answer, those the server refused and those never submitted. '''
+        return [entry for entry in self.entries() if entry.label is None]
+
+    def read_image(self, entry: CorpusEntry) -> bytes:
+        ''' Read the image of a recorded captcha. '''
+        with open(self.__images_path, 'rb') as f:
+            f.seek(entry.offset)
+            return f.read(entry.length)
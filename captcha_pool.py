@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import deque
+from logging import Logger
+from typing import Callable, Optional
+
+class CaptchaPool:
+    ''' A pool of pre-solved captchas, kept topped up by a background thread. '''
+
+    def __init__(self, solve: Callable[[], Optional[dict]], size: int = 2, ttl: float = 60, retry_delay: float = 5, logger: Logger = None):
+        self.__solve = solve
+        self.__logger = logger
+        self.size = size
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        # (expires_at, captcha data), oldest first
+        self.__tokens = deque()
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stopped = threading.Event()
+        self.__thread = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def __len__(self):
+        with self.__lock:
+            self.__evict_expired()
+            return len(self.__tokens)
+
+    def __evict_expired(self):
+        ''' Drop expired tokens, the lock must be held. '''
+        now = time.monotonic()
+        while self.__tokens and self.__tokens[0][0] <= now:
+            self.__tokens.popleft()
+            self.expired += 1
+
+    def put(self, data: dict, expires_at: float = None):
+        ''' Add a solved captcha to the pool. '''
+        if expires_at is None:
+            expires_at = time.monotonic() + self.ttl
+        with self.__lock:
+            self.__tokens.append((expires_at, data))
+
+    def take(self) -> Optional[dict]:
+        ''' Take the oldest unexpired captcha, or None if the pool is empty. '''
+        with self.__lock:
+            self.__evict_expired()
+            if not self.__tokens:
+                self.misses += 1
+                data = None
+            else:
+                self.hits += 1
+                data = self.__tokens.popleft()[1]
+        self.__wakeup.set()
+        return data
+
+    def export(self) -> list:
+        ''' Get the unexpired captchas with their expiry as wall clock timestamps, for saving. '''
+        offset = time.time() - time.monotonic()
+        with self.__lock:
+            self.__evict_expired()
+            return [[expires_at + offset, data] for expires_at, data in self.__tokens]
+
+    def restore(self, captchas: list):
+        ''' Add captchas saved by `export`, dropping the ones that expired meanwhile. '''
+        offset = time.time() - time.monotonic()
+        for expires_at, data in captchas:
+            if expires_at - offset > time.monotonic():
+                self.put(data, expires_at - offset)
+
+    def clear(self):
+        ''' Drop all pooled captchas, e.g. after the session they were issued for has ended. '''
+        with self.__lock:
+            self.__tokens.clear()
+        self.__wakeup.set()
+
+    def stats(self) -> dict:
+        ''' Get the pool counters. '''
+        return {
+            'size': len(self),
+            'capacity': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+        }
+
+    def start(self):
+        ''' Start refilling the pool in the background. '''
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name='captcha-pool', daemon=True)
+        self.__thread.start()
+
+    def stop(self, wait: bool = True):
+        ''' Stop refilling the pool, optionally waiting for an in-progress solve to finish. '''
+        self.__stopped.set()
+        self.__wakeup.set()
+        if self.__thread is not None:
+            if wait:
+                self.__thread.join()
+            self.__thread = None
+
+    def __next_wakeup(self) -> Optional[float]:
+        ''' Seconds until the oldest token expires, or None to wait until woken. '''
+        with self.__lock:
+            if not self.__tokens:
+                return None
+            return max(0, self.__tokens[0][0] - time.monotonic())
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            self.__wakeup.clear()
+            while len(self) < self.size and not self.__stopped.is_set():
+                # the captcha starts ageing when it is issued, not when it is solved
+                expires_at = time.monotonic() + self.ttl
+                try:
+                    data = self.__solve()
+                except Exception:
+                    if self.__logger is not None:
+                        self.__logger.exception('Failed to refill captcha pool.')
+                    data = None
+                if data is None:
+                    self.__stopped.wait(self.retry_delay)
+                    continue
+                self.put(data, expires_at)
+            # sleep until a token is taken or the oldest one expires
+            self.__wakeup.wait(self.__next_wakeup())
@@ -0,0 +1,106 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pprint import pformat
+
+TEXT_FORMAT = '[%(name)s] %(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _sample(value, size: int):
+    ''' Keep the first `size` items of every list and dict in the value, noting how many were left out. '''
+    if isinstance(value, dict):
+        sampled = {key: _sample(item, size) for key, item in itertools.islice(value.items(), size)}
+        if len(value) > size:
+            sampled['...'] = f'{len(value) - size} more'
+        return sampled
+    if isinstance(value, (list, tuple)):
+        sampled = [_sample(item, size) for item in value[:size]]
+        if len(value) > size:
+            sampled.append(f'... {len(value) - size} more')
+        return sampled
+    return value
+
+class Payload:
+    ''' A large object to log, only rendered if the record is emitted.
+
+    Only the first `sample` items of each list and dict are shown, and the text is cut short past `limit` characters.
+    The object is rendered later on the listener thread, so it must not be changed after logging it.
+    '''
+    __slots__ = ('value', 'limit', 'sample')
+
+    def __init__(self, value, limit: int = 4000, sample: int = 10):
+        self.value = value
+        self.limit = limit
+        self.sample = sample
+
+    def __str__(self):
+        text = pformat(_sample(self.value, self.sample), indent=4)
+        if len(text) > self.limit:
+            text = text[:self.limit] + f'... ({len(text) - self.limit} more characters)'
+        return text
+
+class DeferredQueueHandler(QueueHandler):
+    ''' Hands records to the listener as they are, leaving the message formatting to the listener thread. '''
+
+    def prepare(self, record):
+        # the records stay in process, unlike the base class there is no need to render them up front
+        return record
+
+class JsonFormatter(logging.Formatter):
+    ''' Formats records as one JSON object per line. '''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, DATE_FORMAT),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+_listeners = []
+
+def _stop_listeners():
+    # flush what is still queued
+    for listener in _listeners:
+        listener.stop()
+
+atexit.register(_stop_listeners)
+
+def attach_queue(log: logging.Logger, *handlers: logging.Handler) -> QueueListener:
+    ''' Make the handlers handle the logger's records on a background thread, returning the started listener. '''
+    records = queue.SimpleQueue()
+    log.addHandler(DeferredQueueHandler(records))
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    return listener
+
+def get_logger(module_name: str) -> logging.Logger:
+    ''' Get a logger writing to the console and a rotating `bbdc_telebot_<module>.log` file from a background thread.
+
+    Configured by the environment variables BBDCTELEBOTLOGLEVEL (default INFO), BBDCTELEBOTLOGFORMAT
+    (`text` or `json`, for the file), BBDCTELEBOTLOGMAXBYTES and BBDCTELEBOTLOGBACKUPS.
+    '''
+    log = logging.getLogger(module_name)
+    s_handler = logging.StreamHandler()
+    s_handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    f_handler = RotatingFileHandler(
+        f'bbdc_telebot_{module_name}.log',
+        maxBytes=int(os.getenv('BBDCTELEBOTLOGMAXBYTES', str(10 * 1024 * 1024))),
+        backupCount=int(os.getenv('BBDCTELEBOTLOGBACKUPS', '5')),
+        encoding='utf-8',
+    )
+    if os.getenv('BBDCTELEBOTLOGFORMAT', 'text') == 'json':
+        f_handler.setFormatter(JsonFormatter())
+    else:
+        f_handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    # the caller only enqueues, formatting and writing happen on the listener's thread
+    _listeners.append(attach_queue(log, s_handler, f_handler))
+    log.setLevel(os.getenv('BBDCTELEBOTLOGLEVEL', 'INFO').upper())
+    return log
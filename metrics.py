@@ -0,0 +1,164 @@
+import bisect
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, from a local request to a slow captcha login
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# stages measured on a longer scale
+STAGE_BUCKETS = {
+    'scan_delay': (10, 20, 30, 60, 120, 300, 600),
+}
+
+def format_seconds(seconds: float) -> str:
+    return f'{seconds * 1000:.0f}ms' if seconds < 10 else f'{seconds:.0f}s'
+
+class Histogram:
+    ''' Latencies of a stage, in cumulative buckets for Prometheus and a window of recent samples for percentiles. '''
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, window: int = 1000):
+        self.buckets = buckets
+        # the last count is for samples above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.append(seconds)
+
+    def percentile(self, pct: float) -> float:
+        ''' Nearest-rank percentile of the recent samples. '''
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))]
+
+class Stage:
+    ''' The latencies and outcomes of one stage, e.g. the OCR of captchas or the requests to an endpoint. '''
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.histogram = Histogram(buckets)
+        self.successes = 0
+        self.failures = 0
+
+class Timer:
+    ''' Times a block for a stage, a failure if it raises or `success` is set to False. '''
+
+    def __init__(self, metrics, stage: str, labels: dict):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+        self.success = True
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # a cancelled task or a generator closed early neither succeeded nor failed
+        if exc_type is not None and not issubclass(exc_type, Exception):
+            return
+        self.metrics.observe(self.stage, time.perf_counter() - self.started_at, self.success and exc_type is None, **self.labels)
+
+class Metrics:
+    ''' Per-stage latency histograms and success/failure counters, safe to use from several threads. '''
+
+    def __init__(self):
+        self.__stages = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, success: bool = True, **labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.__lock:
+            entry = self.__stages.get(key)
+            if entry is None:
+                entry = self.__stages[key] = Stage(STAGE_BUCKETS.get(stage, DEFAULT_BUCKETS))
+            entry.histogram.observe(seconds)
+            if success:
+                entry.successes += 1
+            else:
+                entry.failures += 1
+
+    def time(self, stage: str, **labels) -> Timer:
+        ''' Time a block, e.g. `with metrics.time('request', endpoint='login') as timer: ...`. '''
+        return Timer(self, stage, labels)
+
+    def clear(self):
+        with self.__lock:
+            self.__stages.clear()
+
+    def summary(self) -> str:
+        ''' A human readable table of the stages, with percentiles of their recent latencies. '''
+        with self.__lock:
+            stages = sorted(self.__stages.items())
+            lines = []
+            for (stage, labels), entry in stages:
+                name = stage + ''.join(f' {value}' for _, value in labels)
+                total = entry.successes + entry.failures
+                histogram = entry.histogram
+                lines.append(
+                    f'{name}: {total} ({entry.failures} failed), '
+                    f'p50 {format_seconds(histogram.percentile(50))}, p95 {format_seconds(histogram.percentile(95))}, '
+                    f'max {format_seconds(max(histogram.recent))}'
+                )
+        return '\n'.join(lines) or 'No measurements yet.'
+
+    def render(self) -> str:
+        ''' The measurements in the Prometheus text exposition format. '''
+        lines = [
+            '# HELP bbdc_stage_seconds Latency of each stage in seconds.',
+            '# TYPE bbdc_stage_seconds histogram',
+        ]
+        totals = [
+            '# HELP bbdc_stage_total Outcomes of each stage.',
+            '# TYPE bbdc_stage_total counter',
+        ]
+        with self.__lock:
+            for (stage, labels), entry in sorted(self.__stages.items()):
+                label_text = ','.join([f'stage="{stage}"'] + [f'{key}="{value}"' for key, value in labels])
+                histogram = entry.histogram
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'bbdc_stage_seconds_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'bbdc_stage_seconds_bucket{{{label_text},le="+Inf"}} {histogram.count}')
+                lines.append(f'bbdc_stage_seconds_sum{{{label_text}}} {histogram.sum}')
+                lines.append(f'bbdc_stage_seconds_count{{{label_text}}} {histogram.count}')
+                totals.append(f'bbdc_stage_total{{{label_text},outcome="success"}} {entry.successes}')
+                totals.append(f'bbdc_stage_total{{{label_text},outcome="failure"}} {entry.failures}')
+        return '\n'.join(lines + totals) + '\n'
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        ''' Serve the measurements for Prometheus to scrape at http://host:port/metrics, call `shutdown` on the result to stop. '''
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('content-type', 'text/plain; version=0.0.4')
+                self.send_header('content-length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+# shared by every agent in the process
+metrics = Metrics()
+
+def endpoint_name(url: str) -> str:
+    ''' The last path segment of an API url, e.g. `login`. '''
+    return url.rsplit('/', 1)[-1]
@@ -0,0 +1,316 @@
+''' A local stand-in for the BBDC API, run with `python mock_server.py --help`. '''
+import argparse
+import base64
+import hashlib
+import json
+import random
+import string
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+# the practical sessions of a day, as (start, end)
+SESSIONS = [('07:30', '09:10'), ('09:20', '11:00'), ('11:30', '13:10'), ('13:20', '15:00'),
+            ('15:20', '17:00'), ('17:10', '18:50'), ('19:20', '21:00'), ('21:10', '22:50')]
+
+def make_synthetic_captcha(text: str, seed: int = None):
+    ''' Render a noisy captcha-like PNG for the given text, returning the encoded bytes. '''
+    rng = random.Random(seed)
+    img = np.full((50, 160, 3), 255, dtype=np.uint8)
+    for i, char in enumerate(text):
+        x = 10 + i * 28 + rng.randint(-3, 3)
+        y = 35 + rng.randint(-4, 4)
+        cv2.putText(img, char, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (40, 40, 40), 2)
+    for _ in range(4):
+        p1 = (rng.randint(0, 159), rng.randint(0, 49))
+        p2 = (rng.randint(0, 159), rng.randint(0, 49))
+        cv2.line(img, p1, p2, (60, 60, 60), 1)
+    ok, encoded = cv2.imencode('.png', img)
+    return encoded.tobytes()
+
+def random_answer(rng: random.Random, length: int = 5):
+    return ''.join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+def make_month_slots(month: date, slots_per_session: int, rng: random.Random) -> dict:
+    ''' Build the slots of a month as listed by listC3PracticalSlotReleased, grouped by day. '''
+    days = {}
+    day = month
+    next_id = month.toordinal() * 1000
+    while day.month == month.month:
+        listing = []
+        for start, end in SESSIONS:
+            for _ in range(slots_per_session):
+                next_id += 1
+                listing.append({
+                    'slotId': next_id,
+                    'slotIdEnc': f'enc{next_id}',
+                    'slotRefName': f'Session {SESSIONS.index((start, end)) + 1}',
+                    'slotRefDate': f'{day} 00:00:00',
+                    'startTime': start,
+                    'endTime': end,
+                    'totalFee': rng.choice([43.6, 54.5, 65.4, 76.3]),
+                    'userFixGrpNo': 'G1',
+                    'bookingProgress': 'Available',
+                    'bookingProgressEnc': f'progress{next_id}',
+                })
+        days[f'{day} 00:00:00'] = listing
+        day += timedelta(days=1)
+    return days
+
+def make_month_listing(month: date, slots_per_session: int, rng: random.Random) -> dict:
+    ''' Build a listC3PracticalSlotReleased response body for a month. '''
+    return {'success': True, 'message': '', 'data': {'releasedSlotListGroupByDay': make_month_slots(month, slots_per_session, rng)}}
+
+class MockBBDC:
+    ''' Serves the endpoints the agents use, for one learner, from memory.
+
+    Captchas are synthetic with known answers, sessions expire after `session_ttl` seconds with a 402,
+    every response is delayed by `latency` plus up to `jitter` seconds, and each slot being booked
+    is lost to another learner with probability `steal_rate`.
+    '''
+
+    def __init__(self, username: str = 'learner', password: str = 'secret', months: int = 3, slots_per_session: int = 2,
+                 latency: float = 0.0, jitter: float = 0.0, session_ttl: float = 30 * 60, steal_rate: float = 0.0,
+                 captchas: int = 50, seed: int = 0):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.session_ttl = session_ttl
+        self.steal_rate = steal_rate
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        # a fixed set of images, rendering one per request would dominate the latency
+        self.__captchas = []
+        for i in range(captchas):
+            answer = random_answer(self.__rng)
+            self.__captchas.append((answer, make_synthetic_captcha(answer, seed=seed + i)))
+        self.__answers = {hashlib.sha1(image).hexdigest(): answer for answer, image in self.__captchas}
+        # verifyCodeId -> answer, for captchas issued and not used yet
+        self.__issued_captchas = {}
+        # token -> time issued
+        self.__sessions = {}
+        first_month = date.today().replace(day=1)
+        # month -> day -> slots, and slot id -> slot
+        self.__months = {}
+        self.__slots = {}
+        for i in range(months):
+            month = first_month + relativedelta(months=i)
+            days = make_month_slots(month, slots_per_session, self.__rng)
+            self.__months[month.strftime('%Y%m')] = days
+            for listing in days.values():
+                for slot in listing:
+                    self.__slots[slot['slotId']] = slot
+        # slot ids taken by someone else, and booking id -> slot id for our learner
+        self.__taken = set()
+        self.__bookings = {}
+        self.__next_booking_id = 1
+        self.logins = 0
+        self.requests = 0
+        self.__server = None
+        self.__routes = {
+            'auth/getLoginCaptchaImage': (False, self.__get_captcha),
+            'auth/login': (False, self.__login),
+            'account/listAccountCourseType': (True, self.__list_course_types),
+            'booking/c3practical/listC3PracticalSlotReleased': (True, self.__list_released_slots),
+            'booking/manage/getCaptchaImage': (True, self.__get_captcha),
+            'booking/c3practical/bookC3PracticalSlot': (True, self.__book_slots),
+            'booking/manage/listAllPracticalBooking': (True, self.__list_bookings),
+            'booking/manage/cancelBooking': (True, self.__cancel_booking),
+        }
+
+    def answer_for(self, image: bytes) -> str:
+        ''' The answer to a captcha image this server issued. '''
+        return self.__answers.get(hashlib.sha1(image).hexdigest(), '')
+
+    def expire_sessions(self):
+        ''' Expire every session, as the server does from time to time. '''
+        with self.__lock:
+            self.__sessions.clear()
+
+    def release_slots(self, count: int) -> list:
+        ''' Make some taken slots available again, returning their ids. '''
+        with self.__lock:
+            released = self.__rng.sample(sorted(self.__taken), min(count, len(self.__taken)))
+            self.__taken.difference_update(released)
+        return released
+
+    def take_slots(self, fraction: float):
+        ''' Have other learners book a fraction of the available slots. '''
+        with self.__lock:
+            available = [slot_id for slot_id in self.__slots if not self.__is_booked(slot_id)]
+            self.__taken.update(self.__rng.sample(available, int(len(available) * fraction)))
+
+    def handle(self, path: str, headers: dict, body: dict):
+        ''' Answer a request to the API path, e.g. `auth/login`, returning the status code and response body. '''
+        delay = self.latency + self.__rng.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        route = self.__routes.get(path)
+        if route is None:
+            return 404, {'success': False, 'message': f'Unknown endpoint: {path}', 'data': None}
+        signed, handler = route
+        with self.__lock:
+            self.requests += 1
+            if signed and not self.__is_signed_in(headers.get('authorization')):
+                return 402, {'success': False, 'message': 'Session expired, please login again.', 'data': None}
+            return 200, handler(body)
+
+    def __is_signed_in(self, token: str) -> bool:
+        issued_at = self.__sessions.get(token)
+        return issued_at is not None and time.monotonic() - issued_at < self.session_ttl
+
+    def __is_booked(self, slot_id: int) -> bool:
+        return slot_id in self.__taken or slot_id in self.__bookings.values()
+
+    def __check_captcha(self, body: dict) -> bool:
+        # a captcha can only be used once, right or wrong
+        answer = self.__issued_captchas.pop(body.get('verifyCodeId'), None)
+        return answer is not None and answer == body.get('verifyCodeValue')
+
+    def __get_captcha(self, body: dict) -> dict:
+        answer, image = self.__rng.choice(self.__captchas)
+        verify_code_id = uuid.uuid4().hex
+        self.__issued_captchas[verify_code_id] = answer
+        return {'success': True, 'message': '', 'data': {
+            'image': 'data:image/png;base64,' + base64.b64encode(image).decode(),
+            'captchaToken': uuid.uuid4().hex,
+            'verifyCodeId': verify_code_id,
+        }}
+
+    def __login(self, body: dict) -> dict:
+        if not self.__check_captcha(body):
+            return {'success': False, 'message': 'Wrong verification code.', 'data': None}
+        if body.get('userId') != self.username or body.get('userPass') != self.password:
+            return {'success': False, 'message': 'Wrong user id or password.', 'data': None}
+        self.logins += 1
+        token = f'Bearer {uuid.uuid4().hex}'
+        self.__sessions[token] = time.monotonic()
+        return {'success': True, 'message': '', 'data': {'tokenContent': token, 'username': self.username}}
+
+    def __list_course_types(self, body: dict) -> dict:
+        return {'success': True, 'message': '', 'data': {'activeCourseList': [{'courseType': '3A', 'authToken': uuid.uuid4().hex}]}}
+
+    def __list_released_slots(self, body: dict) -> dict:
+        days = self.__months.get(body.get('releasedSlotMonth'), {})
+        listing = {}
+        for day, slots in days.items():
+            available = [slot for slot in slots if not self.__is_booked(slot['slotId'])]
+            if available:
+                listing[day] = available
+        return {'success': True, 'message': '', 'data': {'releasedSlotListGroupByDay': listing or None}}
+
+    def __book_slots(self, body: dict) -> dict:
+        if not self.__check_captcha(body):
+            return {'success': False, 'message': 'Wrong verification code.', 'data': None}
+        results = []
+        for slot_id in body.get('slotIdList', []):
+            if slot_id in self.__slots and not self.__is_booked(slot_id) and self.__rng.random() < self.steal_rate:
+                # another learner got there first
+                self.__taken.add(slot_id)
+            success = slot_id in self.__slots and not self.__is_booked(slot_id)
+            if success:
+                self.__bookings[self.__next_booking_id] = slot_id
+                self.__next_booking_id += 1
+            results.append({'slotId': slot_id, 'success': success})
+        if not any(result['success'] for result in results):
+            return {'success': False, 'message': 'The slot is no longer available.', 'data': None}
+        return {'success': True, 'message': '', 'data': {'bookedPracticalSlotList': results}}
+
+    def __list_bookings(self, body: dict) -> dict:
+        bookings = []
+        for booking_id, slot_id in self.__bookings.items():
+            slot = self.__slots[slot_id]
+            bookings.append({
+                'bookingId': booking_id,
+                'theoryType': 'C3',
+                'dataType': 'PRACTICAL',
+                'slotRefName': slot['slotRefName'],
+                'slotRefDesc': slot['slotRefName'],
+                'slotRefDate': slot['slotRefDate'],
+                'startTime': slot['startTime'],
+                'endTime': slot['endTime'],
+                'totalFee': slot['totalFee'],
+                'userFixGrpNo': slot['userFixGrpNo'],
+            })
+        return {'success': True, 'message': '', 'data': {'theoryActiveBookingList': bookings}}
+
+    def __cancel_booking(self, body: dict) -> dict:
+        if self.__bookings.pop(body.get('bookingId'), None) is None:
+            return {'success': False, 'message': 'Booking not found.', 'data': None}
+        return {'success': True, 'message': '', 'data': None}
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        ''' Serve the API in the background, returning the base url to give the agents. '''
+        mock = self
+
+        class MockHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body go out in separate writes, don't let them wait on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('content-length', 0)))
+                body = json.loads(raw) if raw else {}
+                path = self.path.split('/api/', 1)[-1]
+                status, res = mock.handle(path, self.headers, body)
+                data = json.dumps(res).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), MockHandler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, name='mock-bbdc', daemon=True).start()
+        return self.base_url
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}/bbdc-back-service/api'
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default='learner')
+    parser.add_argument('--password', default='secret')
+    parser.add_argument('--slots-per-session', type=int, default=2)
+    parser.add_argument('--taken', type=float, default=0.95, help='fraction of the slots booked by other learners')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--session-ttl', type=float, default=30 * 60)
+    parser.add_argument('--steal-rate', type=float, default=0.0)
+    parser.add_argument('--release-every', type=float, default=60, help='seconds between releases of taken slots')
+    parser.add_argument('--release-count', type=int, default=3)
+    args = parser.parse_args()
+    mock = MockBBDC(args.username, args.password, slots_per_session=args.slots_per_session, latency=args.latency,
+                    jitter=args.jitter, session_ttl=args.session_ttl, steal_rate=args.steal_rate)
+    mock.take_slots(args.taken)
+    print(f'Serving the BBDC API at {mock.start(args.host, args.port)}, started {datetime.now():%H:%M:%S}.')
+    try:
+        while True:
+            time.sleep(args.release_every)
+            print(f'Released slots {mock.release_slots(args.release_count)}.')
+    except KeyboardInterrupt:
+        mock.stop()
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,287 @@
 import cv2
-import subprocess
+import multiprocessing
+import numpy as np
+import os
 import pytesseract
 import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from PIL import Image
 
-class OCRSolver:
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
-    def __init__(self):
+class OCRBackend:
+    ''' An OCR engine that reads a single word from a preprocessed image. '''
+
+    name = ''
+
+    def get_symbols(self, img) -> list:
+        ''' Get the recognised characters with their confidences (0-100). '''
+        raise NotImplementedError
+
+    def close(self):
+        ''' Release any resources held by the engine. '''
         pass
 
-    def __apply_ridge_thinning(self, image_path: str):
+class PytesseractBackend(OCRBackend):
+    ''' Runs a fresh tesseract process for every image. '''
+
+    name = 'pytesseract'
+
+    def get_symbols(self, img) -> list:
+        # tesseract's tsv output only carries word level confidences, share them among the characters
+        data = pytesseract.image_to_data(img, lang='eng', config='--psm 8', output_type=pytesseract.Output.DICT)
+        symbols = []
+        for text, conf in zip(data['text'], data['conf']):
+            conf = float(conf)
+            if conf < 0:
+                continue
+            symbols += [(char, conf) for char in text]
+        return symbols
+
+class TesserocrBackend(OCRBackend):
+    ''' Keeps a single tesseract engine resident, loading the traineddata once. '''
+
+    name = 'tesserocr'
+
+    def __init__(self):
+        if tesserocr is None:
+            raise RuntimeError('tesserocr is not installed.')
+        self.__api = tesserocr.PyTessBaseAPI(lang='eng', psm=tesserocr.PSM.SINGLE_WORD)
+        # the api handle is not thread safe
+        self.__lock = threading.Lock()
+
+    def get_symbols(self, img) -> list:
+        level = tesserocr.RIL.SYMBOL
+        with self.__lock:
+            self.__api.SetImage(Image.fromarray(img))
+            self.__api.Recognize()
+            return [
+                (result.GetUTF8Text(level), result.Confidence(level))
+                for result in tesserocr.iterate_level(self.__api.GetIterator(), level)
+            ]
+
+    def close(self):
+        with self.__lock:
+            self.__api.End()
+
+BACKENDS = {
+    PytesseractBackend.name: PytesseractBackend,
+    TesserocrBackend.name: TesserocrBackend,
+}
+
+def resolve_backend_name(name: str = 'auto') -> str:
+    ''' Get the backend a name stands for, 'auto' prefers the resident engine and falls back to pytesseract. '''
+    if name == 'auto':
+        name = TesserocrBackend.name if tesserocr is not None else PytesseractBackend.name
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown OCR backend: {name}')
+    return name
+
+def make_backend(name: str = 'auto') -> OCRBackend:
+    ''' Create an OCR backend by name, see `resolve_backend_name`. '''
+    return BACKENDS[resolve_backend_name(name)]()
+
+def _worker_context():
+    ''' The start method for the worker processes, which must not inherit the parent's threads and locks by forking. '''
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(method)
+
+@dataclass(frozen=True)
+class Variant:
+    ''' A preprocessing configuration for the captcha image. '''
+    threshold: int = 140
+    blur: tuple = (5, 7)
+    thinning: bool = True
+
+DEFAULT_VARIANTS = (
+    Variant(),
+    Variant(threshold=120),
+    Variant(threshold=160),
+    Variant(blur=(3, 5)),
+    Variant(thinning=False),
+)
+
+# the solver owned by each process pool worker, created once per process
+_worker_solver = None
+
+def _init_worker(backend_name: str):
+    global _worker_solver
+    _worker_solver = OCRSolver(backend_name, variants=(), processes=1)
+
+def _read_variant(img, variant: Variant):
+    return _worker_solver.read_variant(img, variant)
+
+class OCRSolver:
+
+    def __init__(self, backend = 'auto', variants: tuple = DEFAULT_VARIANTS, processes: int = None):
+        self.variants = tuple(variants)
+        if processes is None:
+            processes = min(len(self.variants), os.cpu_count() or 1)
+        self.processes = processes
+        self.__pool = None
+        # solves may come from several threads at once, e.g. agents sharing this solver
+        self.__pool_lock = threading.Lock()
+        if isinstance(backend, str):
+            self.__backend_name = resolve_backend_name(backend)
+            # the workers read the variants with engines of their own, don't keep an idle one here
+            self.__backend = None if self.__uses_pool() else make_backend(self.__backend_name)
+        else:
+            self.__backend_name = backend.name
+            self.__backend = backend
+
+    def describe(self) -> str:
+        ''' A short description of the configuration, e.g. to tell apart captchas recorded by different solvers. '''
+        variants = '; '.join(
+            f'threshold {v.threshold} blur {v.blur[0]}x{v.blur[1]}' + ('' if v.thinning else ' no thinning') for v in self.variants
+        )
+        return f'{self.__backend_name} [{variants}]'
+
+    def __uses_pool(self) -> bool:
+        return self.processes > 1 and len(self.variants) > 1
+
+    @property
+    def backend(self) -> OCRBackend:
+        ''' The engine reading the variants in this process, created on first use when the workers do the reading. '''
+        with self.__pool_lock:
+            if self.__backend is None:
+                self.__backend = make_backend(self.__backend_name)
+            return self.__backend
+
+    def close(self):
+        ''' Release the OCR backend and the worker processes. '''
+        with self.__pool_lock:
+            pool, self.__pool = self.__pool, None
+            backend, self.__backend = self.__backend, None
+        if pool is not None:
+            pool.shutdown()
+        if backend is not None:
+            backend.close()
+
+    def __get_pool(self) -> ProcessPoolExecutor:
+        ''' Get the worker pool, starting it on first use. '''
+        with self.__pool_lock:
+            if self.__pool is None:
+                self.__pool = ProcessPoolExecutor(
+                    self.processes,
+                    mp_context=_worker_context(),
+                    initializer=_init_worker,
+                    initargs=(self.__backend_name,),
+                )
+            return self.__pool
+
+    def __load_image(self, image):
+        ''' Load the image from a path, encoded bytes or a decoded array. '''
+        if isinstance(image, np.ndarray):
+            return image
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            img = cv2.imread(str(image), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError('Failed to decode captcha image.')
+        return img
+
+    def __to_grayscale(self, img):
+        ''' Convert the image to a single unrounded grayscale channel, meant to approximate ImageMagick's `-colorspace gray`. '''
+        if img.ndim == 2:
+            return img.astype(np.float32)
+        # Rec.709 luma, ImageMagick's documented default gray intensity, rather than the Rec.601 weights of cv2's BGR2GRAY;
+        # not yet checked against `convert` output, see tests/test_ocr_parity.py
+        blue, green, red = (img[:, :, channel].astype(np.float32) for channel in range(3))
+        return 0.212656 * red + 0.715158 * green + 0.072186 * blue
+
+    def __thin_ridges(self, img):
+        ''' Remove single pixel ridges, one pass per orientation of the ridge kernel. '''
+        # an approximation of ImageMagick's `-morphology Thinning Ridges`: the kernel `3x1: 0,1,0`
+        # and its 90 degree rotation are applied in turn, each to the result of the previous
+        for axis in (1, 0):
+            padded = np.pad(img, 1, mode='edge')
+            center = padded[1:-1, 1:-1]
+            if axis == 1:
+                before, after = padded[1:-1, :-2], padded[1:-1, 2:]
+            else:
+                before, after = padded[:-2, 1:-1], padded[2:, 1:-1]
+            ridge = (center == 255) & (before == 0) & (after == 0)
+            img = np.where(ridge, 0, img).astype(np.uint8)
+        return img
+
+    def __apply_ridge_thinning(self, img, thinning: bool = True):
         ''' Apply ridge thinning to the image. '''
-        original_img_file = image_path
-        tmp_img_file = '/tmp/bbdc_captcha_tmp.png'
-        command = f'convert {original_img_file} -colorspace gray -separate -average -threshold 90% -negate -morphology Thinning "Ridges" {tmp_img_file}'
-        subprocess.run(command, shell=True)
-        return tmp_img_file
-    
-    def __apply_gaussian_threshold(self, image_path: str):
+        gray = self.__to_grayscale(img)
+        # `-threshold 90%` keeps only pixels brighter than 90% of full intensity, then `-negate`
+        binary = np.where(gray > 0.9 * 255, 0, 255).astype(np.uint8)
+        if not thinning:
+            return binary
+        return self.__thin_ridges(binary)
+
+    def __apply_gaussian_threshold(self, img, blur: tuple = (5, 7), threshold: int = 140):
         ''' Apply gaussian threshold to the image. '''
-        img = cv2.imread(image_path)
         for i in range(2):
-            img = cv2.threshold(cv2.GaussianBlur(img, (5, 7), 0), 140, 255, cv2.THRESH_BINARY)[1]
+            img = cv2.threshold(cv2.GaussianBlur(img, blur, 0), threshold, 255, cv2.THRESH_BINARY)[1]
         return img
 
-    def __get_text(self, img):
-        ''' Use pytesseract to get text from the image. '''
-        text = pytesseract.image_to_string(img, lang='eng', config='--psm 8')
-        text = re.sub(r'[^\w]', '', text)
-        return text
-
-    def solve(self, image_path):
-        ''' Solve the captcha, returning the text. '''
-        thinned = self.__apply_ridge_thinning(image_path)
-        img = self.__apply_gaussian_threshold(thinned)
-        text = self.__get_text(img)
-        return text
+    def __get_symbols(self, img):
+        ''' Use the OCR backend to get the word characters and their confidences from the image. '''
+        return [(char, conf) for char, conf in self.backend.get_symbols(img) if re.fullmatch(r'\w', char)]
+
+    def emulate_convert(self, image):
+        ''' Get the image as preprocessed in place of the original `convert ... -morphology Thinning Ridges` command.
+
+        Parity with `convert` is only checked by tests/test_ocr_parity.py once its fixtures are generated.
+        '''
+        return self.__apply_ridge_thinning(self.__load_image(image))
+
+    def read_variant(self, img, variant: Variant) -> list:
+        ''' Preprocess the decoded image with the variant and read its characters and confidences. '''
+        thinned = self.__apply_ridge_thinning(img, variant.thinning)
+        img = self.__apply_gaussian_threshold(thinned, variant.blur, variant.threshold)
+        return self.__get_symbols(img)
+
+    def __vote(self, readings: list, length: int = None):
+        ''' Combine the readings of all variants by confidence weighted voting per position.
+
+        The returned confidence is how much the variants agree, the winner's share of the weight at its least
+        certain position. The engine's own confidences only weight the votes, a unanimous reading scores 1
+        however unsure tesseract was of it.
+        '''
+        readings = [reading for reading in readings if reading]
+        if length is not None and any(len(reading) == length for reading in readings):
+            readings = [reading for reading in readings if len(reading) == length]
+        if not readings:
+            return '', 0.0
+        # the length backed by the most total confidence wins
+        length_weights = defaultdict(float)
+        for reading in readings:
+            length_weights[len(reading)] += sum(conf for _, conf in reading)
+        length = max(length_weights, key=length_weights.get)
+        candidates = [reading for reading in readings if len(reading) == length]
+        # readings of another length count against every position, with their mean confidence
+        dissent = sum(length_weights[other] / other for other in length_weights if other != length)
+        answer = ''
+        confidence = 1.0
+        for position in range(length):
+            weights = defaultdict(float)
+            for reading in candidates:
+                char, conf = reading[position]
+                weights[char] += conf
+            char = max(weights, key=weights.get)
+            answer += char
+            total = sum(weights.values()) + dissent
+            confidence = min(confidence, weights[char] / total if total > 0 else 0.0)
+        return answer, confidence
+
+    def solve(self, image, length: int = None):
+        ''' Solve the captcha, returning the text and the variants' agreement on it between 0 and 1. The image may be a path, encoded bytes or a decoded array. '''
+        img = self.__load_image(image)
+        if self.__uses_pool():
+            pool = self.__get_pool()
+            readings = list(pool.map(_read_variant, [img] * len(self.variants), self.variants))
+        else:
+            readings = [self.read_variant(img, variant) for variant in self.variants]
+        return self.__vote(readings, length)
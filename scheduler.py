@@ -0,0 +1,130 @@
+import random
+from collections import Counter, deque
+from datetime import datetime, timedelta
+
+class AdaptiveScheduler:
+    ''' Picks the delay before the next slot scan.
+
+    Scans that found new slots are bucketed by time of day, buckets that have seen releases
+    before are polled at the minimum interval, and quiet scans elsewhere back off exponentially.
+    '''
+
+    def __init__(self, min_interval: float = 20, max_interval: float = 10 * 60, bucket_minutes: int = 15,
+                 min_bucket_hits: int = 2, jitter: float = 0.2, max_requests_per_minute: float = 12,
+                 requests_per_scan: int = 3, background_requests_per_minute: float = 0, history: int = 100):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.bucket_minutes = bucket_minutes
+        self.min_bucket_hits = min_bucket_hits
+        self.jitter = jitter
+        self.max_requests_per_minute = max_requests_per_minute
+        self.requests_per_scan = requests_per_scan
+        # spent under the same ceiling outside of scans, e.g. keeping the captcha pool topped up
+        self.background_requests_per_minute = background_requests_per_minute
+        # time of day bucket -> number of scans that found new slots in it
+        self.release_buckets = Counter()
+        # (timestamp, outcome) of recent scans, outcome is one of 'hit', 'miss', 'error'
+        self.recent_scans = deque(maxlen=history)
+        self.quiet_scans = 0
+        self.last_delay = None
+
+    def __bucket(self, moment: datetime) -> int:
+        return (moment.hour * 60 + moment.minute) // self.bucket_minutes
+
+    def __bucket_start(self, bucket: int) -> str:
+        minutes = bucket * self.bucket_minutes
+        return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+    def is_hot(self, moment: datetime) -> bool:
+        ''' Whether slots have been released around this time of day before. '''
+        return self.release_buckets[self.__bucket(moment)] >= self.min_bucket_hits
+
+    def export_state(self) -> dict:
+        ''' Get the learned release windows, for saving. '''
+        return {'bucketMinutes': self.bucket_minutes, 'releaseBuckets': dict(self.release_buckets)}
+
+    def restore_state(self, state: dict):
+        ''' Restore the release windows saved by `export_state`, unless they were bucketed differently. '''
+        if state['bucketMinutes'] != self.bucket_minutes:
+            return
+        # JSON object keys are strings
+        self.release_buckets = Counter({int(bucket): hits for bucket, hits in state['releaseBuckets'].items()})
+
+    def record_scan(self, new_slots: int, failed: bool = False, session_expired: bool = False, bootstrap: bool = False):
+        ''' Record the outcome of a scan.
+
+        A `bootstrap` scan, the first since starting, lists what was released before it, so its new slots are not a release.
+        '''
+        now = datetime.now()
+        if failed or session_expired:
+            outcome = 'error'
+            self.quiet_scans += 1
+        elif bootstrap:
+            outcome = 'miss'
+        elif new_slots > 0:
+            outcome = 'hit'
+            self.release_buckets[self.__bucket(now)] += 1
+            self.quiet_scans = 0
+        else:
+            outcome = 'miss'
+            self.quiet_scans += 1
+        self.recent_scans.append((now.timestamp(), outcome))
+
+    def error_rate(self) -> float:
+        if not self.recent_scans:
+            return 0.0
+        return sum(outcome == 'error' for _, outcome in self.recent_scans) / len(self.recent_scans)
+
+    def __seconds_until_hot(self, now: datetime, horizon: float):
+        ''' Seconds until the next hot bucket starts within the horizon, or None. '''
+        start = now.replace(second=0, microsecond=0)
+        start -= timedelta(minutes=start.minute % self.bucket_minutes)
+        step = timedelta(minutes=self.bucket_minutes)
+        moment = start + step
+        while (moment - now).total_seconds() <= horizon:
+            if self.is_hot(moment):
+                return (moment - now).total_seconds()
+            moment += step
+        return None
+
+    def next_delay(self) -> float:
+        ''' Seconds to wait before the next scan. '''
+        now = datetime.now()
+        if self.is_hot(now):
+            delay = self.min_interval
+        else:
+            delay = min(self.max_interval, self.min_interval * 2 ** min(self.quiet_scans, 16))
+            # wake up for the start of an upcoming release window
+            until_hot = self.__seconds_until_hot(now, delay)
+            if until_hot is not None:
+                delay = max(self.min_interval, until_hot)
+        # back off while the server is failing or kicking us out
+        delay = min(self.max_interval, delay * (1 + 4 * self.error_rate()))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        # never exceed the request rate ceiling, with what the background work leaves of it
+        delay = max(delay, self.requests_per_scan * 60 / self.scan_requests_per_minute())
+        self.last_delay = delay
+        return delay
+
+    def scan_requests_per_minute(self) -> float:
+        ''' The share of the request rate ceiling left for scans. '''
+        return max(1, self.max_requests_per_minute - self.background_requests_per_minute)
+
+    def describe(self) -> str:
+        ''' A human readable summary of the schedule and recent scans. '''
+        now = datetime.now()
+        outcomes = Counter(outcome for _, outcome in self.recent_scans)
+        lines = [
+            f'Mode: {"release window" if self.is_hot(now) else "backing off"}, quiet scans: {self.quiet_scans}.',
+            f'Next scan in: {self.last_delay:.0f}s.' if self.last_delay is not None else 'Next scan: not scheduled yet.',
+            f'Last {len(self.recent_scans)} scans: {outcomes["hit"]} hits, {outcomes["miss"]} misses, {outcomes["error"]} errors.',
+            f'Rate ceiling: {self.max_requests_per_minute:g} requests/min ({self.background_requests_per_minute:g} in the background), '
+            f'{self.requests_per_scan} requests/scan.',
+        ]
+        windows = [
+            f'{self.__bucket_start(bucket)} ({hits} hits)'
+            for bucket, hits in sorted(self.release_buckets.items())
+            if hits >= self.min_bucket_hits
+        ]
+        lines.append('Release windows: ' + (', '.join(windows) if windows else 'none learned yet.'))
+        return '\n'.join(lines)
@@ -0,0 +1,87 @@
+from dataclasses import asdict
+
+from agent import Slot
+from booking_rules import BookingRule
+from slot_store import SlotStore
+
+class SlotIndex:
+    ''' The available slots across scans, keyed by slot id, each with a number that stays the same while it is available.
+
+    Numbers are never reused, so a number from an old announcement can't book a different slot.
+    '''
+
+    def __init__(self):
+        self.__slots = {}
+        self.__numbers = {}
+        self.__by_number = {}
+        self.__next_number = 1
+        # built on the first query after the slots change
+        self.__store = None
+
+    def __len__(self):
+        return len(self.__slots)
+
+    def __iter__(self):
+        ''' Iterate over (number, slot) pairs in number order. '''
+        for number in sorted(self.__by_number):
+            yield number, self.__slots[self.__by_number[number]]
+
+    def get(self, number: int) -> Slot:
+        ''' Get the slot with the given number, or None if it is no longer available. '''
+        slot_id = self.__by_number.get(number)
+        return self.__slots.get(slot_id)
+
+    def number_of(self, slot: Slot) -> int:
+        return self.__numbers.get(slot.slotId)
+
+    def update(self, slots: list):
+        ''' Replace the index with the latest scan, returning the (number, slot) pairs that appeared and vanished. '''
+        latest = {slot.slotId: slot for slot in slots}
+        vanished = [(self.__numbers[slot_id], slot) for slot_id, slot in self.__slots.items() if slot_id not in latest]
+        for number, slot in vanished:
+            self.remove(slot.slotId)
+        appeared = []
+        for slot_id, slot in latest.items():
+            if slot_id not in self.__slots:
+                number = self.__next_number
+                self.__next_number += 1
+                self.__numbers[slot_id] = number
+                self.__by_number[number] = slot_id
+                appeared.append((number, slot))
+            # keep the latest encrypted fields for booking
+            self.__slots[slot_id] = slot
+        self.__store = None
+        return appeared, vanished
+
+    def export(self) -> dict:
+        ''' Get the index as plain data, for saving. '''
+        return {
+            'nextNumber': self.__next_number,
+            'slots': [[number, asdict(slot)] for number, slot in self],
+        }
+
+    @classmethod
+    def restore(cls, data: dict):
+        ''' Rebuild an index saved by `export`. '''
+        index = cls()
+        for number, slot in data['slots']:
+            slot = Slot(**slot)
+            index.__slots[slot.slotId] = slot
+            index.__numbers[slot.slotId] = number
+            index.__by_number[number] = slot.slotId
+        index.__next_number = data['nextNumber']
+        return index
+
+    def remove(self, slot_id: int):
+        ''' Drop a slot, e.g. once it has been booked. '''
+        if slot_id not in self.__slots:
+            return
+        del self.__slots[slot_id]
+        del self.__by_number[self.__numbers.pop(slot_id)]
+        self.__store = None
+
+    def query(self, rule: BookingRule) -> list:
+        ''' Get the (number, slot) pairs matching the rule in date and start time order, without going to the server. '''
+        if self.__store is None:
+            self.__store = SlotStore(list(self.__slots.values()))
+        return [(self.__numbers[slot.slotId], slot) for slot in self.__store.query(rule)]
@@ -0,0 +1,82 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date
+
+from booking_rules import BookingRule, WEEKDAYS
+
+def parse_query(args: list) -> BookingRule:
+    ''' Parse a slot query in shorthand, e.g. `sat,sun 0800-1200 <60 2024-02-01..2024-02-29 name=...`.
+
+    Days, a time window, a maximum fee and a date or date range may be given in any order,
+    `key=value` arguments are read as in `BookingRule.parse`.
+    '''
+    rule_args = []
+    for arg in args:
+        lowered = arg.lower()
+        if '=' in arg:
+            rule_args.append(arg)
+        elif all(day in WEEKDAYS for day in lowered.split(',')):
+            rule_args.append(f'days={lowered}')
+        elif arg.startswith('<'):
+            rule_args.append(f'maxfee={arg[1:].lstrip("=$")}')
+        elif '..' in arg:
+            start, _, end = arg.partition('..')
+            if start:
+                rule_args.append(f'from={start}')
+            if end:
+                rule_args.append(f'to={end}')
+        elif len(arg) == 10 and arg[4] == '-' and arg[7] == '-':
+            # a single day
+            rule_args += [f'from={arg}', f'to={arg}']
+        elif arg[:1].isdigit():
+            rule_args.append(f'time={arg}')
+        else:
+            raise ValueError(f'Unknown query term: {arg}')
+    return BookingRule.parse(rule_args)
+
+class SlotStore:
+    ''' A read-only columnar view of a slot listing, sorted by date then start time for cheap range queries. '''
+
+    def __init__(self, slots: list):
+        # rows are kept in (date, start time) order, so a date range is a contiguous run of rows
+        self.slots = sorted(slots, key=lambda slot: (slot.day, slot.start_minutes))
+        self.days = array('l', [slot.day.toordinal() for slot in self.slots])
+        self.weekdays = array('b', [slot.day.weekday() for slot in self.slots])
+        self.starts = array('h', [slot.start_minutes for slot in self.slots])
+        self.ends = array('h', [slot.end_minutes for slot in self.slots])
+        self.fees = array('d', [slot.totalFee for slot in self.slots])
+        # rows by start time, for time window queries that don't narrow the dates
+        self.by_start = array('l', sorted(range(len(self.slots)), key=lambda row: self.starts[row]))
+        self.sorted_starts = array('h', [self.starts[row] for row in self.by_start])
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __date_rows(self, from_date: date, to_date: date) -> range:
+        lo = 0 if from_date is None else bisect_left(self.days, from_date.toordinal())
+        hi = len(self.days) if to_date is None else bisect_right(self.days, to_date.toordinal())
+        return range(lo, hi)
+
+    def __start_rows(self, start_minutes: int, end_minutes: int) -> list:
+        lo = 0 if start_minutes is None else bisect_left(self.sorted_starts, start_minutes)
+        hi = len(self.sorted_starts) if end_minutes is None else bisect_right(self.sorted_starts, end_minutes)
+        # back to date order
+        return sorted(self.by_start[lo:hi])
+
+    def query(self, rule: BookingRule) -> list:
+        ''' Get the slots matching the rule, in date and start time order. '''
+        if rule.from_date is not None or rule.to_date is not None or rule.start_minutes is None:
+            rows = self.__date_rows(rule.from_date, rule.to_date)
+            if rule.start_minutes is not None:
+                rows = [row for row in rows if self.starts[row] >= rule.start_minutes]
+        else:
+            rows = self.__start_rows(rule.start_minutes, rule.end_minutes)
+        if rule.weekdays is not None:
+            rows = [row for row in rows if self.weekdays[row] in rule.weekdays]
+        if rule.end_minutes is not None:
+            rows = [row for row in rows if self.ends[row] <= rule.end_minutes]
+        if rule.max_fee is not None:
+            rows = [row for row in rows if self.fees[row] <= rule.max_fee]
+        if rule.names is not None:
+            rows = [row for row in rows if self.slots[row].slotRefName in rule.names]
+        return [self.slots[row] for row in rows]
@@ -0,0 +1,17 @@
+import json
+import os
+
+def save_state(path: str, state: dict):
+    ''' Atomically write the state as JSON, readable by the owner only since it holds session tokens. '''
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+def load_state(path: str):
+    ''' Read the state saved by `save_state`, or None if there is none. '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,62 @@
+''' Store captchas with ImageMagick's output for them, for test_ocr_parity.py. Needs `convert` on the PATH.
+
+Run `python tests/make_ocr_parity_fixtures.py [--corpus DIR]`, recorded captchas are used when a corpus is given,
+otherwise colored synthetic ones.
+'''
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from captcha_corpus import CaptchaCorpus
+from mock_server import random_answer
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ocr_parity')
+# the preprocessing command the solver used to run, see OCRSolver.emulate_convert
+CONVERT = ['-colorspace', 'gray', '-separate', '-average', '-threshold', '90%', '-negate', '-morphology', 'Thinning', 'Ridges']
+
+def make_colored_captcha(text: str, seed: int) -> bytes:
+    ''' A captcha with colored text, noise and a light background, so the gray conversion matters. '''
+    rng = random.Random(seed)
+    img = np.full((50, 160, 3), [rng.randint(225, 255) for _ in range(3)], dtype=np.uint8)
+    for _ in range(150):
+        img[rng.randint(0, 49), rng.randint(0, 159)] = [rng.randint(0, 255) for _ in range(3)]
+    for i, char in enumerate(text):
+        color = [rng.randint(0, 200) for _ in range(3)]
+        cv2.putText(img, char, (10 + i * 28 + rng.randint(-3, 3), 35 + rng.randint(-4, 4)), cv2.FONT_HERSHEY_SIMPLEX, 1.1, color, 2)
+    for _ in range(4):
+        color = [rng.randint(0, 255) for _ in range(3)]
+        cv2.line(img, (rng.randint(0, 159), rng.randint(0, 49)), (rng.randint(0, 159), rng.randint(0, 49)), color, 1)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--corpus', help='directory recorded with Agent.record_captchas')
+    parser.add_argument('--count', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if shutil.which('convert') is None:
+        sys.exit('ImageMagick `convert` is not on the PATH.')
+    if args.corpus:
+        corpus = CaptchaCorpus(args.corpus)
+        images = [corpus.read_image(entry) for entry in corpus.entries()[:args.count]]
+    else:
+        rng = random.Random(args.seed)
+        images = [make_colored_captcha(random_answer(rng), seed=args.seed + i) for i in range(args.count)]
+    os.makedirs(FIXTURES, exist_ok=True)
+    for i, image in enumerate(images):
+        source = os.path.join(FIXTURES, f'{i:02d}.png')
+        with open(source, 'wb') as f:
+            f.write(image)
+        subprocess.run(['convert', source] + CONVERT + [os.path.join(FIXTURES, f'{i:02d}.convert.png')], check=True)
+    print(f'Stored {len(images)} captchas in {FIXTURES}.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+''' Checks the in-memory preprocessing against the ImageMagick command it replaced, on stored captchas. '''
+import glob
+import os
+import sys
+import unittest
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_solver import OCRSolver
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'ocr_parity')
+# share of pixels allowed to differ, for rounding at the edges of the 90% threshold
+MAX_MISMATCH = 0.002
+
+def fixture_pairs() -> list:
+    ''' (captcha, convert output) paths of the stored fixtures. '''
+    outputs = sorted(glob.glob(os.path.join(FIXTURES, '*.convert.png')))
+    return [(output.replace('.convert.png', '.png'), output) for output in outputs]
+
+def gaussian_threshold(img):
+    ''' The step the solver always ran after `convert`, with the default variant. '''
+    for _ in range(2):
+        img = cv2.threshold(cv2.GaussianBlur(img, (5, 7), 0), 140, 255, cv2.THRESH_BINARY)[1]
+    return img
+
+@unittest.skipUnless(fixture_pairs(), 'parity with convert is unverified: no fixtures, '
+                     'run tests/make_ocr_parity_fixtures.py where ImageMagick is installed and commit tests/fixtures/ocr_parity')
+class OCRParityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.solver = OCRSolver('pytesseract', variants=(), processes=1)
+
+    def tearDown(self):
+        self.solver.close()
+
+    def assertClose(self, actual, expected, name: str):
+        self.assertEqual(actual.shape, expected.shape, name)
+        mismatch = np.count_nonzero(actual != expected) / expected.size
+        self.assertLessEqual(mismatch, MAX_MISMATCH, f'{name}: {mismatch:.2%} of pixels differ')
+
+    def test_matches_convert(self):
+        for captcha, output in fixture_pairs():
+            expected = cv2.imread(output, cv2.IMREAD_GRAYSCALE)
+            actual = self.solver.emulate_convert(captcha)
+            self.assertClose(actual, expected, os.path.basename(captcha))
+            # what tesseract is given, where a stray pixel is most likely to be blurred away
+            self.assertClose(gaussian_threshold(actual), gaussian_threshold(expected), os.path.basename(captcha) + ' blurred')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+from typing import Optional
+
+class TokenManager:
+    ''' Tracks the age of the session tokens to refresh them before the server expires them.
+
+    The lifetime starts as a guess and shrinks to the age at which the server was seen to expire a session,
+    growing back toward the guess by `growth` for every session that lasts until it is refreshed.
+    '''
+
+    def __init__(self, max_age: float = 30 * 60, refresh_margin: float = 5 * 60, min_age: float = 5 * 60, growth: float = 1.25):
+        self.default_max_age = max_age
+        self.max_age = max_age
+        self.growth = growth
+        self.refresh_margin = refresh_margin
+        self.min_age = min_age
+        self.issued_at = None
+        # bumped on every login, lets callers tell whether someone else already refreshed
+        self.generation = 0
+        # bumped on every finished login, successful or not, lets callers tell whether a login was tried since they looked
+        self.logins = 0
+        # restored tokens not yet accepted by the server, which may have dropped them for other reasons while we were down
+        self.restored = False
+
+    def mark_issued(self, issued_at: float = None):
+        ''' Record freshly issued tokens. '''
+        if self.issued_at is not None and not self.restored:
+            # the previous session lasted until it was replaced, an early expiry may have been a one-off
+            self.max_age = min(self.default_max_age, self.max_age * self.growth)
+        self.issued_at = time.time() if issued_at is None else issued_at
+        self.generation += 1
+        self.restored = False
+
+    def mark_restored(self, issued_at: float):
+        ''' Record tokens restored from a previous run. '''
+        self.mark_issued(issued_at)
+        self.restored = True
+
+    def confirm(self):
+        ''' Record the server accepting the tokens. '''
+        self.restored = False
+
+    def record_login(self):
+        ''' Record a finished login attempt, whatever its outcome. '''
+        self.logins += 1
+
+    def invalidate(self):
+        self.issued_at = None
+        self.restored = False
+
+    @property
+    def age(self) -> Optional[float]:
+        if self.issued_at is None:
+            return None
+        return time.time() - self.issued_at
+
+    def record_expiry(self):
+        ''' Learn from the server expiring the session at the current age. '''
+        age = self.age
+        # a restored session refused on first use says nothing of how long sessions last
+        if age is not None and age < self.max_age and not self.restored:
+            self.max_age = max(self.min_age, age)
+        self.invalidate()
+
+    def is_valid(self) -> bool:
+        ''' Whether the tokens exist and are younger than their expected lifetime. '''
+        return self.issued_at is not None and self.age < self.max_age
+
+    def seconds_until_refresh(self) -> float:
+        ''' Seconds until the tokens should be refreshed ahead of their expiry, 0 if due now. '''
+        if self.issued_at is None:
+            return 0
+        margin = min(self.refresh_margin, self.max_age / 2)
+        return max(0, self.max_age - margin - self.age)